@@ -1,33 +1,71 @@
-from flask import Flask
+from flask import Flask, Request, current_app
 from flask_pymongo import PyMongo
 from flask_login import LoginManager
 import os
 from dotenv import load_dotenv
+from app.metrics import Metrics
+from app.profiling import Profiler
 
 load_dotenv()
 
 mongo = PyMongo()
 login_manager = LoginManager()
+metrics = Metrics()
+profiler = Profiler()
+
+class AppRequest(Request):
+    @property
+    def max_content_length(self):
+        # Zip imports of whole question banks are far larger than other uploads
+        if self.endpoint == 'main.import_questions':
+            return current_app.config['IMPORT_MAX_CONTENT_LENGTH']
+        return super().max_content_length
 
 def create_app():
     app = Flask(__name__)
+    app.request_class = AppRequest
     
     # Configuration
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
     app.config['MONGO_URI'] = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/thuyvan_db')
+    app.config['MONGO_ENSURE_INDEXES'] = os.environ.get('MONGO_ENSURE_INDEXES', '1') == '1'
     app.config['UPLOAD_FOLDER'] = 'uploads'
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['METRICS_SERVER_TIMING'] = os.environ.get('METRICS_SERVER_TIMING', '0') == '1'
+    app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', 'profiles')
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+    app.config['PROFILE_ENDPOINT'] = os.environ.get('PROFILE_ENDPOINT')
+    app.config['CACHE_SYNC_INTERVAL'] = float(os.environ.get('CACHE_SYNC_INTERVAL', '5'))
+    app.config['COMPRESS_ENABLED'] = os.environ.get('COMPRESS_ENABLED', '1') == '1'
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', '1024'))
+    app.config['RESULT_RETENTION_DAYS'] = int(os.environ.get('RESULT_RETENTION_DAYS', '180'))
+    app.config['IMPORT_WORKERS'] = int(os.environ.get('IMPORT_WORKERS', os.cpu_count() or 1))
+    app.config['IMPORT_MAX_CONTENT_LENGTH'] = int(os.environ.get('IMPORT_MAX_CONTENT_LENGTH', 256 * 1024 * 1024))
     
     # Ensure upload folder exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
     # Initialize extensions
-    mongo.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    listeners = [metrics.command_listener] if app.config['METRICS_ENABLED'] else []
+    mongo.init_app(app, event_listeners=listeners)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
     login_manager.login_message = 'Vui lòng đăng nhập để tiếp tục.'
     login_manager.login_message_category = 'warning'
     
+    from app.cache import cache
+    from app.assets import assets
+    from app.mathsvg import math_html
+    from app.compression import compression
+    cache.init_app(app)
+    assets.init_app(app)
+    compression.init_app(app)
+    app.add_template_filter(math_html)
+    
     # User loader
     from app.models import User
     
@@ -35,6 +73,14 @@ def create_app():
     def load_user(user_id):
         return User.get(user_id)
     
+    if app.config['MONGO_ENSURE_INDEXES']:
+        from app.models import ensure_indexes
+        with app.app_context():
+            try:
+                ensure_indexes()
+            except Exception as e:
+                app.logger.warning('Could not create MongoDB indexes: %s', e)
+    
     # Register blueprints
     from app.auth import auth_bp
     from app.views import main_bp
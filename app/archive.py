@@ -0,0 +1,114 @@
+"""Retention for ``exam_results``: archive old results into monthly rollups.
+
+Results older than ``RESULT_RETENTION_DAYS`` are moved, full answers
+included, to ``exam_results_archive`` and folded into ``exam_rollups``: one
+small document per user, subject and month holding counts, sums, best and
+worst, which is all the history and statistics pages need. ``exam_results``
+then only holds the recent window, so the queries over it stay bounded.
+
+Each batch is copied to the archive (flagged ``rolled_up: False``), removed
+from ``exam_results``, and the rollups it touches are recomputed from the
+archive before the batch is flagged as rolled up. Recomputing a rollup is
+idempotent, so an interrupted run is simply resumed by the next one.
+``rebuild_rollups()`` recomputes every rollup from the archive.
+"""
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app import mongo
+
+BATCH_SIZE = 500
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def rollup_id(user_id, subject_id, month):
+    return f'{user_id}:{subject_id or "none"}:{month:%Y-%m}'
+
+
+def _rollup_updates(results):
+    updates = {}
+    for r in results:
+        month = month_start(r['completed_at'])
+        key = rollup_id(r['user_id'], r.get('subject_id'), month)
+        update = updates.setdefault(key, {
+            '$inc': {'count': 0, 'score': 0, 'total_questions': 0, 'percentage_sum': 0, 'duration_seconds': 0},
+            '$max': {'best': r['percentage'], 'last_at': r['completed_at']},
+            '$min': {'worst': r['percentage'], 'first_at': r['completed_at']},
+            '$setOnInsert': {'user_id': r['user_id'], 'subject_id': r.get('subject_id'), 'month': month},
+        })
+        inc = update['$inc']
+        inc['count'] += 1
+        inc['score'] += r.get('score', 0)
+        inc['total_questions'] += r.get('total_questions', 0)
+        inc['percentage_sum'] += r['percentage']
+        inc['duration_seconds'] += r.get('duration_seconds', 0)
+        update['$max']['best'] = max(update['$max']['best'], r['percentage'])
+        update['$max']['last_at'] = max(update['$max']['last_at'], r['completed_at'])
+        update['$min']['worst'] = min(update['$min']['worst'], r['percentage'])
+        update['$min']['first_at'] = min(update['$min']['first_at'], r['completed_at'])
+    return [UpdateOne({'_id': key}, update, upsert=True) for key, update in updates.items()]
+
+
+def _roll_up_pending():
+    """Bring the rollups of archived results not yet counted up to date."""
+    count = 0
+    while True:
+        batch = list(mongo.db.exam_results_archive.find(
+            {'rolled_up': False}, {'user_id': 1, 'subject_id': 1, 'completed_at': 1}, limit=BATCH_SIZE))
+        if not batch:
+            return count
+        refresh_rollups({(r['user_id'], r.get('subject_id'), month_start(r['completed_at'])) for r in batch})
+        mongo.db.exam_results_archive.update_many(
+            {'_id': {'$in': [r['_id'] for r in batch]}}, {'$set': {'rolled_up': True}})
+        count += len(batch)
+
+
+def archive_results(retention_days, now=None):
+    """Archive and roll up every result older than ``retention_days``; return how many."""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    _roll_up_pending()
+
+    count = 0
+    while True:
+        batch = list(mongo.db.exam_results.find(
+            {'completed_at': {'$lt': cutoff}}, sort=[('completed_at', 1)], limit=BATCH_SIZE))
+        if not batch:
+            return count
+
+        for r in batch:
+            r['rolled_up'] = False
+        try:
+            mongo.db.exam_results_archive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Copied by an earlier, interrupted run
+            if any(err['code'] != 11000 for err in e.details['writeErrors']):
+                raise
+        mongo.db.exam_results.delete_many({'_id': {'$in': [r['_id'] for r in batch]}})
+        count += _roll_up_pending()
+
+
+def rebuild_rollups():
+    """Recompute every rollup from the archive; return the number of rollups."""
+    mongo.db.exam_results_archive.update_many({}, {'$set': {'rolled_up': False}})
+    mongo.db.exam_rollups.delete_many({})
+    _roll_up_pending()
+    return mongo.db.exam_rollups.count_documents({})
+
+
+def refresh_rollups(keys):
+    """Recompute the rollups of the given (user_id, subject_id, month) keys from the archive (idempotent)."""
+    for user_id, subject_id, month in keys:
+        next_month = month_start(month + timedelta(days=32))
+        results = list(mongo.db.exam_results_archive.find({
+            'user_id': user_id,
+            'subject_id': subject_id,
+            'completed_at': {'$gte': month, '$lt': next_month},
+        }, {'answers': 0}))
+        mongo.db.exam_rollups.delete_one({'_id': rollup_id(user_id, subject_id, month)})
+        if results:
+            mongo.db.exam_rollups.bulk_write(_rollup_updates(results), ordered=False)
@@ -0,0 +1,215 @@
+"""Self-hosted, fingerprinted and precompressed static assets.
+
+``python build_assets.py`` downloads the pinned third-party libraries into
+``app/static/vendor``, copies every asset into ``app/static/dist`` under a
+content-hashed name, writes gzip (and brotli, when the ``brotli`` package is
+installed) variants next to each text file and records the mapping in
+``app/static/dist/manifest.json``.
+
+Own files are fingerprinted one by one (``css/style.3f2a9c1e.css``). A vendor
+package is fingerprinted as a whole directory (``vendor/mathjax-81c0d2aa/...``)
+because its files load each other through relative paths (icon fonts,
+MathJax components).
+
+Templates reference assets with ``asset_url('css/style.css')``. With a
+manifest the URL points at the fingerprinted copy, served from ``/assets/``
+with a one-year immutable Cache-Control and the best precompressed variant
+the client accepts. Without one (development) own files come from the plain
+``static`` endpoint and vendor files from the CDN.
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+import tarfile
+import urllib.request
+
+from flask import abort, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+VENDOR = {
+    'bootstrap': ('5.1.3', ['dist/css/bootstrap.min.css', 'dist/js/bootstrap.bundle.min.js']),
+    'bootstrap-icons': ('1.8.1', ['font/bootstrap-icons.css', 'font/fonts/']),
+    'mathjax': ('3.2.2', ['es5/']),
+}
+NPM_TARBALL = 'https://registry.npmjs.org/{name}/-/{name}-{version}.tgz'
+CDN_URL = 'https://cdn.jsdelivr.net/npm/{name}@{version}/{path}'
+
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.map', '.txt', '.html', '.ttf', '.otf', '.eot'}
+MIN_COMPRESS_SIZE = 256
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def immutable_response(path, mimetype=None, etag=True):
+    """Serve ``path`` (or its best precompressed sibling) as a never-changing resource.
+
+    ``etag`` may be a string, e.g. a content hash, to use instead of the mtime-based tag.
+    """
+    path = os.path.abspath(path)
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    encoding = None
+    for name, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[name] and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, name
+            break
+    if isinstance(etag, str) and encoding:
+        etag = f'{etag}-{encoding}'
+
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=31536000)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class Assets:
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.dist = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dist = os.path.join(app.static_folder, 'dist')
+        manifest_path = os.path.join(self.dist, 'manifest.json')
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+        self._served = set(self.manifest.values())
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self._serve)
+        app.jinja_env.globals['asset_url'] = self.url
+
+    def url(self, path):
+        fingerprinted = self.manifest.get(path)
+        if fingerprinted:
+            return url_for('assets', filename=fingerprinted)
+
+        if path.startswith('vendor/'):
+            name, _, rest = path[len('vendor/'):].partition('/')
+            if name in VENDOR:
+                return CDN_URL.format(name=name, version=VENDOR[name][0], path=rest)
+        return url_for('static', filename=path)
+
+    def _serve(self, filename):
+        if filename not in self._served:
+            abort(404)
+        return immutable_response(os.path.join(self.dist, filename))
+
+
+def _hash_files(paths, root):
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(os.path.relpath(path, root).replace(os.sep, '/').encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:8]
+
+
+def _walk(root):
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+def download_vendor(static_folder, force=False):
+    """Fetch the pinned VENDOR packages from the npm registry into static/vendor."""
+    for name, (version, wanted) in VENDOR.items():
+        target = os.path.join(static_folder, 'vendor', name)
+        stamp = os.path.join(target, '.version')
+        if not force and os.path.isfile(stamp):
+            with open(stamp) as f:
+                if f.read() == version:
+                    continue
+
+        print(f'Downloading {name}@{version}...')
+        with urllib.request.urlopen(NPM_TARBALL.format(name=name, version=version), timeout=60) as response:
+            data = response.read()
+
+        shutil.rmtree(target, ignore_errors=True)
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+            for member in tar.getmembers():
+                path = member.name.split('/', 1)[-1]  # strip the "package/" prefix
+                if not member.isfile() or '..' in path.split('/'):
+                    continue
+                if not any(path == w or (w.endswith('/') and path.startswith(w)) for w in wanted):
+                    continue
+                dest = os.path.join(target, *path.split('/'))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                with tar.extractfile(member) as src, open(dest, 'wb') as out:
+                    shutil.copyfileobj(src, out)
+
+        with open(stamp, 'w') as f:
+            f.write(version)
+
+
+def compress_file(path):
+    """Write .gz (and .br) siblings of ``path`` when it is compressible and worth it."""
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return
+
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    for suffix, compressed in variants:
+        if len(compressed) < len(data) * 0.9:
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+
+
+def build(static_folder, download=True):
+    """Fingerprint and precompress every asset of ``static_folder`` into static/dist."""
+    if download:
+        download_vendor(static_folder)
+
+    dist = os.path.join(static_folder, 'dist')
+    vendor = os.path.join(static_folder, 'vendor')
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+
+    # Own files, one fingerprint each
+    for path in _walk(static_folder):
+        if path.startswith((dist + os.sep, vendor + os.sep)):
+            continue
+        logical = os.path.relpath(path, static_folder).replace(os.sep, '/')
+        stem, ext = os.path.splitext(logical)
+        manifest[logical] = f'{stem}.{_hash_files([path], static_folder)}{ext}'
+
+    # Vendor packages, one fingerprint per package directory
+    if os.path.isdir(vendor):
+        for name in sorted(os.listdir(vendor)):
+            package = os.path.join(vendor, name)
+            files = [p for p in _walk(package) if os.path.basename(p) != '.version']
+            digest = _hash_files(files, package)
+            for path in files:
+                rel = os.path.relpath(path, package).replace(os.sep, '/')
+                manifest[f'vendor/{name}/{rel}'] = f'vendor/{name}-{digest}/{rel}'
+
+    for logical, fingerprinted in manifest.items():
+        src = os.path.join(static_folder, *logical.split('/'))
+        dest = os.path.join(dist, *fingerprinted.split('/'))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(src, dest)
+        compress_file(dest)
+
+    with open(os.path.join(dist, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+assets = Assets()
@@ -0,0 +1,84 @@
+"""Read-through cache for rarely changing reference data.
+
+Values are cached in process memory under a name and a tag (``subjects``,
+``questions``, ...). Each tag has a version number stored in a single document
+of the ``cache_versions`` collection. Writers bump the versions of the tags they
+touch, and every worker re-reads that document at most once per
+``CACHE_SYNC_INTERVAL`` seconds. Entries cached under an older version are then
+reloaded on next use, so unchanged data costs no DB round trip per page.
+
+Cached values are shared between requests and must be treated as read-only.
+"""
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+from app import mongo
+
+VERSIONS_ID = 'reference'
+
+
+class ReferenceCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sync_interval = 5.0
+        self.clear()
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_SYNC_INTERVAL', 5.0)
+        self.sync_interval = float(app.config['CACHE_SYNC_INTERVAL'])
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._versions = {}
+            self._synced_at = None
+
+    def get(self, name, loader, tag=None):
+        """Return the cached value of ``name``, calling ``loader`` when missing or stale."""
+        tag = tag or name
+        self._sync()
+
+        version = self._versions.get(tag, 0)
+        entry = self._entries.get(name)
+        if entry is not None and entry[0] == (tag, version):
+            return entry[1]
+
+        value = loader()
+        with self._lock:
+            # Only keep the value if no invalidation of its tag arrived meanwhile.
+            if self._versions.get(tag, 0) == version:
+                self._entries[name] = ((tag, version), value)
+        return value
+
+    def invalidate(self, *tags):
+        """Bump ``tags`` for every worker; this process sees the change immediately."""
+        doc = mongo.db.cache_versions.find_one_and_update(
+            {'_id': VERSIONS_ID},
+            {'$inc': {f'versions.{tag}': 1 for tag in tags}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._apply(doc.get('versions', {}))
+
+    def _sync(self):
+        now = time.monotonic()
+        if self._synced_at is not None and now - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = now
+
+        doc = mongo.db.cache_versions.find_one({'_id': VERSIONS_ID})
+        self._apply(doc.get('versions', {}) if doc else {})
+
+    def _apply(self, versions):
+        with self._lock:
+            self._versions = dict(versions)
+            self._entries = {
+                name: entry for name, entry in self._entries.items()
+                if entry[0][1] == self._versions.get(entry[0][0], 0)
+            }
+
+
+cache = ReferenceCache()
@@ -0,0 +1,115 @@
+"""Streamed rendering and on-the-fly gzip/brotli compression of responses.
+
+``stream_page`` renders a template incrementally, so the first bytes of a
+multi-megabyte page leave while the rest is still being rendered.
+
+``Compression`` negotiates ``br``/``gzip`` for HTML, JSON and other text
+responses. Buffered responses are compressed in one go when larger than
+``COMPRESS_MIN_SIZE``; streamed ones are compressed chunk by chunk with a sync
+flush after each chunk, so compression never holds back the first byte.
+Responses that already carry a ``Content-Encoding`` (precompressed assets) and
+file responses are left alone.
+"""
+import gzip
+import zlib
+
+from flask import Response, current_app, get_flashed_messages, request, stream_with_context
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+STREAM_BUFFER = 64  # template events per chunk, roughly 8-16 KB of HTML
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4  # the higher levels cost more CPU than they save on the wire
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/javascript',
+    'application/json', 'application/javascript', 'image/svg+xml',
+}
+
+
+def stream_page(template_name, **context):
+    """Like ``render_template``, but streams the page in buffered chunks."""
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+    # Pop the flashed messages now: once the body starts streaming the session
+    # cookie has already been sent and could no longer be cleared.
+    get_flashed_messages(with_categories=True)
+
+    stream = template.stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return Response(stream_with_context(stream), mimetype='text/html')
+
+
+def _compress_stream(chunks, encoding, level):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+        compress, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)  # noqa: E731
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compress(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compression:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config['COMPRESS_ENABLED']:
+            app.after_request(self._after_request)
+
+    def _encoding(self):
+        offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+        return request.accept_encodings.best_match(offered)
+
+    def _after_request(self, response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self._encoding()
+        if not encoding:
+            return response
+
+        level = BROTLI_QUALITY if encoding == 'br' else GZIP_LEVEL
+
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding, level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+                return response
+            if encoding == 'br':
+                response.set_data(brotli.compress(data, quality=level))
+            else:
+                response.set_data(gzip.compress(data, compresslevel=level))
+
+        response.headers['Content-Encoding'] = encoding
+        if response.headers.get('ETag'):
+            # The compressed body is a different representation of the resource
+            response.headers['ETag'] = response.headers['ETag'].rstrip('"') + f'-{encoding}"'
+        return response
+
+
+compression = Compression()
@@ -0,0 +1,209 @@
+"""Server-side exam sessions.
+
+Starting an exam creates one compact ``exam_sessions`` document: the assigned
+question ids, the deadline and the answers given so far (``{question_id:
+option}``). The exam page autosaves each change as a small delta, so a
+dropped connection or a reload loses nothing: ``/exam/session/<id>`` resumes
+the attempt with its answers and remaining time. Submitting grades the stored
+answers with one ``$in`` read of the answered questions.
+
+A TTL index on ``expires_at`` removes sessions once they can no longer be
+resumed or resubmitted.
+"""
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app import leaderboard, mastery, mongo
+from app.models import ExamResult
+
+SUBMIT_GRACE = timedelta(seconds=60)  # answers in flight when the timer runs out
+KEEP_AFTER_DEADLINE = timedelta(hours=1)
+GRADING_LEASE = timedelta(minutes=1)  # after which a retry takes over a stalled submission
+OPTION_KEYS = set('abcdef')
+
+
+def create(user_id, questions, subject_id, time_limit, practice=False):
+    now = datetime.utcnow()
+    deadline = now + timedelta(minutes=time_limit)
+    return mongo.db.exam_sessions.insert_one({
+        'user_id': ObjectId(user_id),
+        'subject_id': ObjectId(subject_id) if subject_id else None,
+        'question_ids': [q['_id'] for q in questions],
+        'answers': {},
+        'practice': practice,
+        'started_at': now,
+        'deadline': deadline,
+        'expires_at': deadline + KEEP_AFTER_DEADLINE,
+    }).inserted_id
+
+
+def get(session_id, user_id):
+    try:
+        return mongo.db.exam_sessions.find_one({'_id': ObjectId(session_id), 'user_id': ObjectId(user_id)})
+    except Exception:
+        return None
+
+
+def questions(session):
+    """The session's questions, in their assigned order."""
+    found = {q['_id']: q for q in mongo.db.questions.find({'_id': {'$in': session['question_ids']}})}
+    return [found[qid] for qid in session['question_ids'] if qid in found]
+
+
+def remaining_seconds(session):
+    return max(0, int((session['deadline'] - datetime.utcnow()).total_seconds()))
+
+
+def _answer_updates(delta):
+    """Validate an answers delta ({question_id: option or None}); return (update, question ids)."""
+    updates = {'$set': {}, '$unset': {}}
+    ids = []
+    for qid, answer in (delta or {}).items():
+        if not ObjectId.is_valid(qid) or (answer is not None and answer not in OPTION_KEYS):
+            continue
+        ids.append(ObjectId(qid))
+        if answer is None:
+            updates['$unset'][f'answers.{qid}'] = ''
+        else:
+            updates['$set'][f'answers.{qid}'] = answer
+    return {op: fields for op, fields in updates.items() if fields}, ids
+
+
+def _open_filter(session_id, user_id, ids):
+    """Match the session while it still accepts answers, and only if all ``ids`` are assigned to it."""
+    query = {
+        '_id': ObjectId(session_id),
+        'user_id': ObjectId(user_id),
+        'submitted_at': None,
+        'deadline': {'$gt': datetime.utcnow() - SUBMIT_GRACE},
+    }
+    if ids:
+        query['question_ids'] = {'$all': ids}
+    return query
+
+
+def valid_delta(delta):
+    """True if ``delta`` is empty or has at least one valid answer to save."""
+    return not delta or bool(_answer_updates(delta)[1])
+
+
+def save_answers(session_id, user_id, delta):
+    """Apply an autosave delta in one write; return False if the session is closed or the delta invalid."""
+    updates, ids = _answer_updates(delta)
+    if not updates:
+        return not delta
+    try:
+        query = _open_filter(session_id, user_id, ids)
+    except Exception:
+        return False
+    return mongo.db.exam_sessions.update_one(query, updates).matched_count == 1
+
+
+def submit(session_id, user, delta=None):
+    """Grade the stored answers (plus a last unsaved ``delta``) and record the result.
+
+    Returns the result summary, None if the session does not exist, or an
+    empty dict while another submission is grading it. A session is graded
+    once: submitting it again returns the same summary. Grading holds a
+    lease, so a submission that failed half way is finished by the next retry.
+    """
+    session = get(session_id, user.id)
+    if not session:
+        return None
+    if session.get('summary'):
+        return session['summary']
+
+    if not session.get('submitted_at'):
+        # Save the last answers (ignored past the deadline), then close the session
+        save_answers(session_id, user.id, delta)
+        now = datetime.utcnow()
+        mongo.db.exam_sessions.update_one(
+            {'_id': session['_id'], 'submitted_at': None},
+            {'$set': {'submitted_at': now, 'expires_at': now + KEEP_AFTER_DEADLINE}})
+
+    now = datetime.utcnow()
+    session = mongo.db.exam_sessions.find_one_and_update(
+        {'_id': session['_id'], 'summary': None, 'grading_until': {'$not': {'$gt': now}}},
+        {'$set': {'grading_until': now + GRADING_LEASE}},
+        return_document=ReturnDocument.AFTER)
+    if session is None:
+        # Graded by a concurrent submission, which may still be writing its summary
+        return (get(session_id, user.id) or {}).get('summary') or {}
+    return _grade(session, user)
+
+
+def _grade(session, user):
+    answers = session['answers']
+    found = {str(q['_id']): q for q in mongo.db.questions.find(
+        {'_id': {'$in': [ObjectId(qid) for qid in answers]}},
+        {'question': 1, 'options': 1, 'correct_answer': 1, 'subject_id': 1})}
+
+    score = 0
+    detailed_answers = []
+    graded = []
+    for qid in map(str, session['question_ids']):
+        question = found.get(qid)
+        if question is None or qid not in answers:
+            continue
+        is_correct = answers[qid] == question['correct_answer']
+        score += is_correct
+        detailed_answers.append({
+            'question_id': qid,
+            'question': question['question'],
+            'user_answer': answers[qid],
+            'correct_answer': question['correct_answer'],
+            'is_correct': is_correct,
+            'options': question['options']
+        })
+        graded.append((question['_id'], question.get('subject_id'), is_correct))
+
+    total_questions = len(detailed_answers)
+    ended = min(session['submitted_at'], session['deadline'])
+    duration = max(0, int((ended - session['started_at']).total_seconds()))
+    subject_id = session.get('subject_id')
+    recorded = set(session.get('recorded', []))
+
+    # The result shares the session's id, so a retry cannot create it twice
+    try:
+        ExamResult.create(
+            user_id=user.id,
+            score=score,
+            total_questions=total_questions,
+            answers=detailed_answers,
+            duration_seconds=duration,
+            subject_id=subject_id,
+            result_id=session['_id']
+        )
+    except DuplicateKeyError:
+        pass  # created by an earlier, interrupted submission
+    if 'mastery' not in recorded:
+        mastery.record_attempts(user.id, graded)
+        _mark_recorded(session, 'mastery')
+    if 'leaderboard' not in recorded:
+        leaderboard.record_result(
+            user_id=user.id,
+            username=user.username,
+            subject_id=subject_id,
+            score=score,
+            total_questions=total_questions,
+            duration_seconds=duration
+        )
+        _mark_recorded(session, 'leaderboard')
+
+    summary = {
+        'score': score,
+        'total': total_questions,
+        'percentage': round((score / total_questions) * 100, 2) if total_questions > 0 else 0,
+        'duration': duration,
+        'result_id': str(session['_id'])
+    }
+    mongo.db.exam_sessions.update_one(
+        {'_id': session['_id']}, {'$set': {'summary': summary}, '$unset': {'grading_until': ''}})
+    return summary
+
+
+def _mark_recorded(session, step):
+    mongo.db.exam_sessions.update_one({'_id': session['_id']}, {'$addToSet': {'recorded': step}})
@@ -0,0 +1,121 @@
+"""Content-addressed store for pictures embedded in imported questions.
+
+Every image is stored once under ``<UPLOAD_FOLDER>/images/<ab>/<sha256>.<ext>``
+whatever the number of documents or banks it appears in. Pictures wider than
+``WEB_MAX_WIDTH`` also get a downscaled ``<sha256>.web.<ext>`` variant, which is
+what the exam pages show; the original stays one click away. Questions keep a
+list of ``{'name', 'web', 'width', 'height'}`` entries in ``images``.
+"""
+import hashlib
+import io
+import os
+import re
+
+from docx.oxml.ns import qn
+from PIL import Image
+
+from app.assets import compress_file
+
+WEB_MAX_WIDTH = 960
+JPEG_QUALITY = 85
+NAME_RE = re.compile(r'^[0-9a-f]{64}(\.web)?\.[a-z0-9]{2,5}$')
+
+# Content types Word uses for embedded pictures; anything else keeps the
+# extension of the part name.
+EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'image/bmp': 'bmp',
+    'image/tiff': 'tiff',
+    'image/svg+xml': 'svg',
+    'image/x-emf': 'emf',
+    'image/x-wmf': 'wmf',
+}
+# Raster formats browsers display. EMF/WMF previews are skipped, and so is SVG:
+# it can carry scripts, and Word keeps a PNG fallback next to it anyway.
+DISPLAYABLE = {'png', 'jpg', 'gif', 'webp'}
+PIL_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'gif': 'GIF'}
+
+
+def image_path(folder, name):
+    return os.path.join(folder, 'images', name[:2], name)
+
+
+def _write(path, data):
+    if os.path.isfile(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    compress_file(path)
+
+
+def _web_variant(data, ext):
+    """Return (data, width, height) of the web-sized image, or None when the original will do."""
+    if ext not in PIL_FORMATS:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
+            if width <= WEB_MAX_WIDTH or getattr(img, 'is_animated', False):
+                return None
+            img.thumbnail((WEB_MAX_WIDTH, WEB_MAX_WIDTH * height // width), Image.LANCZOS)
+            out = io.BytesIO()
+            if ext == 'jpg':
+                img.convert('RGB').save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            else:
+                img.save(out, PIL_FORMATS[ext], optimize=True)
+            return out.getvalue(), img.size[0], img.size[1]
+    except Exception:
+        return None
+
+
+def _size(data):
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except Exception:
+        return None, None
+
+
+def store(data, ext, folder):
+    """Store ``data`` in the content-addressed store; return its ``images`` entry."""
+    digest = hashlib.sha256(data).hexdigest()
+    name = f'{digest}.{ext}'
+    web_name = f'{digest}.web.{ext}'
+    _write(image_path(folder, name), data)
+
+    variant = _web_variant(data, ext)
+    if variant:
+        _write(image_path(folder, web_name), variant[0])
+        web_width, web_height = variant[1], variant[2]
+    else:
+        web_name = name
+        web_width, web_height = _size(data)
+
+    return {'name': name, 'web': web_name, 'width': web_width, 'height': web_height}
+
+
+def paragraph_images(paragraph, folder, seen=None):
+    """Store the pictures embedded in a python-docx paragraph; return their entries.
+
+    ``seen`` maps relationship ids to entries already stored for the same document.
+    """
+    seen = {} if seen is None else seen
+    entries = []
+    for blip in paragraph._element.iter(qn('a:blip')):
+        rel_id = blip.get(qn('r:embed'))
+        if not rel_id:
+            continue
+        if rel_id not in seen:
+            part = paragraph.part.related_parts.get(rel_id)
+            if part is None:
+                continue
+            ext = EXTENSIONS.get(part.content_type) or os.path.splitext(part.partname)[1].lstrip('.').lower()
+            seen[rel_id] = store(part.blob, ext, folder) if ext in DISPLAYABLE else None
+        if seen[rel_id] and seen[rel_id] not in entries:
+            entries.append(seen[rel_id])
+    return entries
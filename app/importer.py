@@ -0,0 +1,404 @@
+"""Question import pipeline shared by every file format.
+
+A source turns an uploaded file into raw question dicts, one at a time:
+Word documents (``parse_docx``), CSV, Excel (.xlsx) and JSON Lines. The rows
+then go through the same generator stages: ``normalize`` (``clean_text`` and
+formula pre-rendering), ``validate`` and ``insert_batches``, which looks up
+duplicates with one ``$in`` query per batch and writes with ``insert_many``.
+Nothing holds more than one batch in memory, so a 100k-row spreadsheet
+imports in bounded memory.
+
+Sources and the first two stages never touch the database; they only need
+the upload folder, passed explicitly, for pictures and formulas.
+
+Tabular files have a header row naming the columns ``question``, ``a`` to
+``f``, ``answer``, and optionally ``category`` and ``difficulty`` (Vietnamese
+names such as ``câu hỏi`` and ``đáp án`` are accepted too).
+
+A zip of such files is imported by ``import_zip``: the files are parsed and
+validated in parallel in a process pool, then all their rows go through one
+batched, deduplicated write phase. An optional ``manifest.json`` maps file
+names to subjects (by name or id); other files go to the default subject.
+"""
+import codecs
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import chain, islice
+
+from bson import ObjectId
+
+from app import mongo
+from app.mathsvg import prerender, question_texts
+from app.models import Question
+from app.utils import clean_text, parse_docx
+
+BATCH_SIZE = 1000
+MAX_ERRORS = 50
+OPTION_KEYS = 'abcdef'
+DIFFICULTIES = ('easy', 'medium', 'hard')
+DEFAULT_CATEGORY = 'Thủy văn công trình'
+
+COLUMNS = {
+    'question': 'question', 'câu hỏi': 'question', 'cau hoi': 'question', 'noi dung': 'question',
+    'answer': 'correct_answer', 'correct_answer': 'correct_answer', 'đáp án': 'correct_answer',
+    'dap an': 'correct_answer',
+    'category': 'category', 'chủ đề': 'category', 'chu de': 'category',
+    'difficulty': 'difficulty', 'độ khó': 'difficulty', 'do kho': 'difficulty',
+}
+COLUMNS.update({key: key for key in OPTION_KEYS})
+COLUMNS.update({f'option_{key}': key for key in OPTION_KEYS})
+
+
+def _map_header(header):
+    return [COLUMNS.get(str(name or '').strip().lower()) for name in header]
+
+
+def _row_to_question(columns, values):
+    question = {'options': {}}
+    for column, value in zip(columns, values):
+        if column is None or value is None or str(value).strip() == '':
+            continue
+        value = str(value).strip()
+        if column in OPTION_KEYS:
+            question['options'][column] = value
+        else:
+            question[column] = value
+    return question
+
+
+def _lines(file):
+    # Decoded by hand: io.TextIOWrapper needs readable()/seekable(), which the
+    # SpooledTemporaryFile of uploads lacks before Python 3.11.
+    return codecs.iterdecode(file, 'utf-8-sig')
+
+
+def read_csv(file, folder=None):
+    lines = _lines(file)
+    head = []
+    while sum(map(len, head)) < 4096:
+        line = next(lines, None)
+        if line is None:
+            break
+        head.append(line)
+    try:
+        dialect = csv.Sniffer().sniff(''.join(head), delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(chain(head, lines), dialect)
+    columns = _map_header(next(reader, []))
+    for values in reader:
+        yield _row_to_question(columns, values)
+
+
+def read_xlsx(file, folder=None):
+    # openpyxl rather than pandas.read_excel: only the read-only workbook
+    # streams rows instead of loading the whole sheet.
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        columns = _map_header(next(rows, []))
+        for values in rows:
+            yield _row_to_question(columns, values)
+    finally:
+        workbook.close()
+
+
+def read_jsonl(file, folder=None):
+    for line in _lines(file):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield {'error': 'Dòng JSON không hợp lệ'}
+            continue
+        if not isinstance(data, dict):
+            yield {'error': 'Mỗi dòng phải là một đối tượng JSON'}
+            continue
+        options = data.get('options') or {k: data[k] for k in OPTION_KEYS if data.get(k)}
+        yield {
+            'question': data.get('question'),
+            'options': options,
+            'correct_answer': data.get('correct_answer') or data.get('answer'),
+            'category': data.get('category'),
+            'difficulty': data.get('difficulty'),
+        }
+
+
+SOURCES = {
+    '.docx': parse_docx,
+    '.csv': read_csv,
+    '.xlsx': read_xlsx,
+    '.jsonl': read_jsonl,
+}
+
+
+def source_for(filename):
+    return SOURCES.get(os.path.splitext(filename.lower())[1])
+
+
+def _text(value):
+    """A cell or JSON value as a stripped string, or None if it is not a scalar."""
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return None
+    return str(value).strip()
+
+
+def _type_error(row):
+    options = row.get('options') or {}
+    if not isinstance(options, dict):
+        return 'Phương án phải có dạng {"a": ..., "b": ...}'
+    if any(_text(v) is None for v in options.values()):
+        return 'Nội dung phương án phải là văn bản'
+    for field in ('question', 'correct_answer', 'category', 'difficulty'):
+        if _text(row.get(field)) is None:
+            return f'Trường "{field}" phải là văn bản'
+    return None
+
+
+def normalize(rows, folder):
+    for number, row in enumerate(rows, 1):
+        row['row'] = number
+        if 'error' not in row:
+            error = _type_error(row)
+            if error:
+                row['error'] = error
+        if 'error' in row:
+            yield row
+            continue
+        row['question'] = clean_text(_text(row.get('question'))).strip()
+        row['options'] = {str(k).strip().lower(): clean_text(_text(v)).strip()
+                          for k, v in (row.get('options') or {}).items() if _text(v)}
+        row['correct_answer'] = _text(row.get('correct_answer')).lower()
+        row['category'] = _text(row.get('category')) or DEFAULT_CATEGORY
+        row['difficulty'] = _text(row.get('difficulty')).lower() or 'medium'
+        row['math'] = prerender(question_texts(row), folder)
+        yield row
+
+
+def validate(rows, report):
+    for row in rows:
+        if 'error' in row:
+            error = row['error']
+        elif not row['question']:
+            error = 'Thiếu nội dung câu hỏi'
+        elif not set(row['options']) <= set(OPTION_KEYS):
+            error = f'Phương án phải là {", ".join(OPTION_KEYS)}'
+        elif len(row['options']) < 2:
+            error = 'Cần ít nhất 2 phương án'
+        elif row['correct_answer'] not in row['options']:
+            error = f'Đáp án "{row["correct_answer"]}" không có trong các phương án'
+        elif row['difficulty'] not in DIFFICULTIES:
+            error = f'Độ khó "{row["difficulty"]}" không hợp lệ'
+        else:
+            yield row
+            continue
+
+        report['invalid'] += 1
+        if len(report['errors']) < MAX_ERRORS:
+            report['errors'].append({'row': row['row'], 'error': error})
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert_batches(rows, subject_id, report, batch_size=BATCH_SIZE):
+    """Write valid rows in deduplicated batches.
+
+    A row may carry its own ``subject_id`` and ``report`` (zip imports merge
+    the rows of many files into one write phase).
+    """
+    subject_id = ObjectId(subject_id) if subject_id else None
+    for batch in _batches(rows, batch_size):
+        texts = list({row['question'] for row in batch})
+        existing = {(q['question'], q['correct_answer']) for q in mongo.db.questions.find(
+            {'question': {'$in': texts}}, {'question': 1, 'correct_answer': 1})}
+
+        now = datetime.utcnow()
+        documents = []
+        for row in batch:
+            target = row.get('report', report)
+            key = (row['question'], row['correct_answer'])
+            if key in existing:
+                target['duplicates'] += 1
+                continue
+            existing.add(key)
+            target['inserted'] += 1
+            documents.append({
+                'question': row['question'],
+                'options': row['options'],
+                'correct_answer': row['correct_answer'],
+                'category': row['category'],
+                'difficulty': row['difficulty'],
+                'subject_id': row.get('subject_id', subject_id),
+                'math': row['math'],
+                'images': row.get('images', []),
+                'created_at': now,
+            })
+
+        if documents:
+            mongo.db.questions.insert_many(documents, ordered=False)
+
+
+def new_report():
+    return {'inserted': 0, 'duplicates': 0, 'invalid': 0, 'errors': []}
+
+
+def run_import(rows, subject_id, folder, report=None):
+    """Run raw question dicts through the pipeline into the bank of ``subject_id``."""
+    report = report or new_report()
+    insert_batches(validate(normalize(rows, folder), report), subject_id, report)
+    if report['inserted']:
+        Question.invalidate_cache()
+    return report
+
+
+def import_file(file, filename, subject_id, folder):
+    """Import an uploaded file with the source matching its extension."""
+    source = source_for(filename)
+    if source is None:
+        raise ValueError(f'Định dạng file không được hỗ trợ: {filename}')
+    return run_import(source(file, folder), subject_id, folder)
+
+
+MANIFEST = 'manifest.json'
+MAX_UNZIPPED_SIZE = 512 * 1024 * 1024
+MIN_PARALLEL_FILES = 4  # below this, starting the worker processes costs more than it saves
+
+
+def parse_file(path, filename, folder):
+    """Parse and validate one file without touching the database; return (rows, report).
+
+    Runs in the worker processes of ``import_zip``.
+    """
+    report = new_report()
+    source = source_for(filename)
+    try:
+        with open(path, 'rb') as f:
+            rows = list(validate(normalize(source(f, folder), folder), report))
+    except Exception as e:
+        report['failed'] = f'Không đọc được file: {e}'
+        rows = []
+    return rows, report
+
+
+def _resolve_subjects(manifest, subjects):
+    by_id = {str(s['_id']): s['_id'] for s in subjects}
+    by_name = {s['name'].strip().lower(): s['_id'] for s in subjects}
+    resolved = {}
+    for filename, subject in manifest.items():
+        subject = str(subject).strip()
+        resolved[filename] = by_id.get(subject) or by_name.get(subject.lower())
+    return resolved
+
+
+def _extract(archive, directory):
+    """Extract the importable members of ``archive``; return {name: path}."""
+    members = [m for m in archive.infolist()
+               if not m.is_dir() and not m.filename.startswith('__MACOSX/')
+               and source_for(m.filename) and not os.path.basename(m.filename).startswith('~$')]
+    if sum(m.file_size for m in members) > MAX_UNZIPPED_SIZE:
+        raise ValueError('File zip quá lớn sau khi giải nén')
+
+    paths = {}
+    for index, member in enumerate(members):
+        name = member.filename
+        # Never trust member paths: every file gets a flat, numbered name
+        path = os.path.join(directory, f'{index}{os.path.splitext(name)[1].lower()}')
+        with archive.open(member) as src, open(path, 'wb') as out:
+            shutil.copyfileobj(src, out)
+        paths[name] = path
+    return paths
+
+
+def import_zip(file, default_subject_id, folder, subjects, workers=None):
+    """Import every supported file of a zip archive; return (total report, per-file reports)."""
+    try:
+        archive = zipfile.ZipFile(file)
+    except zipfile.BadZipFile:
+        raise ValueError('File zip không hợp lệ')
+
+    with archive, tempfile.TemporaryDirectory() as directory:
+        manifest = {}
+        if MANIFEST in archive.namelist():
+            try:
+                manifest = json.loads(archive.read(MANIFEST).decode('utf-8-sig'))
+            except ValueError:
+                raise ValueError(f'{MANIFEST} không hợp lệ')
+            if not isinstance(manifest, dict):
+                raise ValueError(f'{MANIFEST} phải là một đối tượng JSON {{"tên file": "môn học"}}')
+        manifest_subjects = _resolve_subjects(manifest, subjects)
+        names = {s['_id']: s['name'] for s in subjects}
+        default_subject = ObjectId(default_subject_id) if default_subject_id else None
+
+        paths = _extract(archive, directory)
+        if not paths:
+            raise ValueError('Không có file .docx, .csv, .xlsx hoặc .jsonl nào trong file zip')
+
+        file_reports = []
+        for name in paths:
+            base = os.path.basename(name)
+            subject_id = default_subject
+            report = new_report()
+            report['file'] = name
+            for key in (name, base):
+                if key in manifest:
+                    subject_id = manifest_subjects[key]
+                    if subject_id is None:
+                        report['failed'] = f'Không tìm thấy môn học "{manifest[key]}" trong manifest'
+                    break
+            report['subject_id'] = subject_id
+            report['subject_name'] = names.get(subject_id, '')
+            file_reports.append(report)
+
+        # Parse phase: CPU bound, one process per core. "spawn" keeps the
+        # workers clear of the parent's MongoDB client and its threads; it
+        # re-imports the entry script, so that must build the app only under
+        # its ``__main__`` guard (as run.py does).
+        todo = [r for r in file_reports if 'failed' not in r]
+        workers = min(workers or os.cpu_count() or 1, len(todo))
+        jobs = [(paths[r['file']], r['file'], folder) for r in todo]
+        if workers > 1 and len(jobs) >= MIN_PARALLEL_FILES:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                parsed = list(pool.map(parse_file, *zip(*jobs)))
+        else:
+            parsed = [parse_file(*job) for job in jobs]
+
+        # Write phase: every file's rows merged into the same batches
+        merged = []
+        for report, (rows, parsed_report) in zip(todo, parsed):
+            report['invalid'] = parsed_report['invalid']
+            report['errors'] = parsed_report['errors']
+            if 'failed' in parsed_report:
+                report['failed'] = parsed_report['failed']
+            for row in rows:
+                row['subject_id'] = report['subject_id']
+                row['report'] = report
+            merged.append(rows)
+        insert_batches(chain.from_iterable(merged), default_subject_id, new_report())
+
+    total = new_report()
+    for report in file_reports:
+        for key in ('inserted', 'duplicates', 'invalid'):
+            total[key] += report[key]
+    if total['inserted']:
+        Question.invalidate_cache()
+    return total, file_reports
@@ -0,0 +1,315 @@
+"""Precomputed per-subject leaderboards.
+
+Each scope (a subject id, or ``'all'`` across subjects) has three rankings:
+
+* ``best``: each user's best percentage,
+* ``fastest``: each user's fastest perfect score,
+* ``average``: each user's average over their last ``LEADERBOARD_RECENT`` exams.
+
+``best`` and ``fastest`` are bounded top-K lists in one ``leaderboards``
+document per scope, merged incrementally on every submitted exam with an
+optimistic version check. Averages can go down as well as up, which a top-K
+list cannot track, so they live in ``leaderboard_recent`` (one document per
+scope and user holding the last N percentages) and the top K are read through
+the ``(scope, average)`` index. Reads are served from memory for
+``LEADERBOARD_TTL`` seconds, so a leaderboard costs O(K) however many results
+exist. ``rebuild()`` recomputes everything from the exam history, archived
+results included; ``refresh_users()`` only recomputes the entries of users
+whose past results changed.
+"""
+import itertools
+import threading
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from flask import current_app
+from pymongo import ReplaceOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app import mongo
+
+ALL = 'all'
+
+_lock = threading.Lock()
+_boards = {}
+
+
+def _settings():
+    config = current_app.config
+    return (config.get('LEADERBOARD_SIZE', 10),
+            config.get('LEADERBOARD_RECENT', 5),
+            config.get('LEADERBOARD_MIN_QUESTIONS', 10))
+
+
+def _scopes(subject_id):
+    return [str(subject_id), ALL] if subject_id else [ALL]
+
+
+def _best_key(entry):
+    return (-entry['percentage'], entry['completed_at'])
+
+
+def _fastest_key(entry):
+    return (entry['duration_seconds'], entry['completed_at'])
+
+
+def _merge(entries, entry, key, size):
+    """Merge ``entry`` into a top-``size`` list keeping one (the better) entry per user."""
+    current = next((e for e in entries if e['user_id'] == entry['user_id']), None)
+    if current is not None and key(current) <= key(entry):
+        return entries
+
+    merged = [e for e in entries if e['user_id'] != entry['user_id']]
+    merged.append(entry)
+    merged.sort(key=key)
+    return merged[:size]
+
+
+def record_result(user_id, username, subject_id, score, total_questions, duration_seconds, completed_at=None):
+    """Fold one submitted exam into the leaderboards of its subject and of 'all'."""
+    if total_questions <= 0:
+        return
+
+    size, recent, min_questions = _settings()
+    percentage = score / total_questions * 100
+    completed_at = completed_at or datetime.utcnow()
+    user_id = ObjectId(user_id)
+
+    for scope in _scopes(subject_id):
+        _push_recent(scope, user_id, username, percentage, recent)
+
+        if total_questions >= min_questions:
+            best = {'user_id': user_id, 'username': username, 'percentage': percentage,
+                    'score': score, 'total_questions': total_questions, 'completed_at': completed_at}
+            fastest = None
+            if score == total_questions:
+                fastest = {'user_id': user_id, 'username': username,
+                           'duration_seconds': duration_seconds, 'completed_at': completed_at}
+            _update_board(scope, best, fastest, size)
+
+        with _lock:
+            _boards.pop(scope, None)
+
+
+def _push_recent(scope, user_id, username, percentage, recent):
+    doc = mongo.db.leaderboard_recent.find_one_and_update(
+        {'_id': f'{scope}:{user_id}'},
+        {
+            '$push': {'scores': {'$each': [percentage], '$slice': -recent}},
+            '$set': {'scope': scope, 'user_id': user_id, 'username': username, 'updated_at': datetime.utcnow()}
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    scores = doc['scores']
+    mongo.db.leaderboard_recent.update_one(
+        {'_id': doc['_id']},
+        {'$set': {'average': sum(scores) / len(scores), 'count': len(scores)}}
+    )
+
+
+def _update_board(scope, best, fastest, size, retries=5):
+    for _ in range(retries):
+        board = mongo.db.leaderboards.find_one({'_id': scope}) or {'best': [], 'fastest': [], 'version': 0}
+
+        new_best = _merge(board['best'], best, _best_key, size)
+        new_fastest = board['fastest']
+        if fastest is not None:
+            new_fastest = _merge(board['fastest'], fastest, _fastest_key, size)
+
+        if new_best is board['best'] and new_fastest is board['fastest']:
+            return
+
+        try:
+            result = mongo.db.leaderboards.update_one(
+                {'_id': scope, 'version': board['version']},
+                {
+                    '$set': {'best': new_best, 'fastest': new_fastest, 'updated_at': datetime.utcnow()},
+                    '$inc': {'version': 1}
+                },
+                upsert=board['version'] == 0
+            )
+        except DuplicateKeyError:
+            continue  # Created concurrently, retry against the stored document
+        if result.matched_count or result.upserted_id is not None:
+            return
+
+
+def get_leaderboard(subject_id=None):
+    """Return {'best': [...], 'fastest': [...], 'average': [...]} for a subject or for all subjects."""
+    scope = str(subject_id) if subject_id else ALL
+    ttl = current_app.config.get('LEADERBOARD_TTL', 30)
+    now = time.monotonic()
+
+    with _lock:
+        cached = _boards.get(scope)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    size, _, _ = _settings()
+    board = mongo.db.leaderboards.find_one({'_id': scope}) or {}
+    average = list(mongo.db.leaderboard_recent.find(
+        {'scope': scope, 'average': {'$exists': True}},
+        {'user_id': 1, 'username': 1, 'average': 1, 'count': 1},
+        sort=[('average', -1), ('count', -1)],
+        limit=size
+    ))
+    data = {
+        'best': board.get('best', []),
+        'fastest': board.get('fastest', []),
+        'average': average,
+        'updated_at': board.get('updated_at'),
+    }
+
+    with _lock:
+        _boards[scope] = (now + ttl, data)
+    return data
+
+
+def _history(query):
+    fields = {'user_id': 1, 'subject_id': 1, 'score': 1, 'total_questions': 1,
+              'duration_seconds': 1, 'completed_at': 1}
+    # Archived results are all older than the live ones
+    return itertools.chain(
+        mongo.db.exam_results_archive.find(query, fields, sort=[('completed_at', 1)]),
+        mongo.db.exam_results.find(query, fields, sort=[('completed_at', 1)]))
+
+
+def _scan(history, usernames, only=None):
+    """Fold results, oldest first, into ({scope: board}, {scope: {user_id: recent scores}})."""
+    size, recent, min_questions = _settings()
+    boards = {}
+    recents = {}
+    for r in history:
+        username = usernames.get(r['user_id'])
+        total = r.get('total_questions', 0)
+        if not username or total <= 0:
+            continue
+        percentage = r['score'] / total * 100
+
+        scopes = [only] if only else _scopes(r.get('subject_id'))
+        for scope in scopes:
+            scores = recents.setdefault(scope, {}).setdefault(r['user_id'], [])
+            scores.append(percentage)
+            del scores[:-recent]
+
+            if total < min_questions:
+                continue
+            board = boards.setdefault(scope, {'best': [], 'fastest': []})
+            board['best'] = _merge(board['best'], {
+                'user_id': r['user_id'], 'username': username, 'percentage': percentage,
+                'score': r['score'], 'total_questions': total, 'completed_at': r['completed_at']
+            }, _best_key, size)
+            if r['score'] == total:
+                board['fastest'] = _merge(board['fastest'], {
+                    'user_id': r['user_id'], 'username': username,
+                    'duration_seconds': r['duration_seconds'], 'completed_at': r['completed_at']
+                }, _fastest_key, size)
+    return boards, recents
+
+
+def _set_board(scope, board, now):
+    # Bumping the version makes concurrent _update_board calls retry on top of it
+    update = {'$set': {'best': board['best'], 'fastest': board['fastest'], 'updated_at': now},
+              '$inc': {'version': 1}}
+    try:
+        mongo.db.leaderboards.update_one({'_id': scope}, update, upsert=True)
+    except DuplicateKeyError:
+        mongo.db.leaderboards.update_one({'_id': scope}, update)  # created concurrently
+
+
+def _set_recents(recents, usernames, now):
+    requests = [ReplaceOne({'_id': f'{scope}:{user_id}'}, {
+        'scope': scope, 'user_id': user_id, 'username': usernames[user_id], 'scores': scores,
+        'average': sum(scores) / len(scores), 'count': len(scores), 'updated_at': now
+    }, upsert=True) for scope, users in recents.items() for user_id, scores in users.items()]
+    if requests:
+        mongo.db.leaderboard_recent.bulk_write(requests, ordered=False)
+
+
+def rebuild(subject_id=None):
+    """Recompute leaderboards from the exam history; all scopes unless ``subject_id`` is given.
+
+    Documents are overwritten in place rather than dropped and re-inserted, so
+    exams submitted during a rebuild are never lost or rejected.
+    """
+    started = datetime.utcnow()
+    usernames = {u['_id']: u['username'] for u in mongo.db.users.find({}, {'username': 1})}
+    only = str(subject_id) if subject_id else None
+    boards, recents = _scan(_history({'subject_id': ObjectId(subject_id)} if subject_id else {}), usernames, only)
+
+    for scope, board in boards.items():
+        _set_board(scope, board, started)
+    _set_recents(recents, usernames, started)
+
+    # Drop what the history no longer backs, sparing documents written since we started
+    stale = {'updated_at': {'$not': {'$gte': started}}}
+    if only:
+        mongo.db.leaderboards.delete_many({'_id': only, **stale})
+        mongo.db.leaderboard_recent.delete_many({'scope': only, **stale})
+    else:
+        mongo.db.leaderboards.delete_many(stale)
+        mongo.db.leaderboard_recent.delete_many(stale)
+
+    with _lock:
+        _boards.clear()
+
+    return len(boards)
+
+
+def _refresh_board(scope, user_ids, fresh, now, retries=5):
+    """Swap the entries of ``user_ids`` on one board for ``fresh`` ones; False if the board needs a rebuild."""
+    size, _, _ = _settings()
+    for _ in range(retries):
+        board = mongo.db.leaderboards.find_one({'_id': scope}) or {'best': [], 'fastest': [], 'version': 0}
+        merged = {}
+        for name, key in (('best', _best_key), ('fastest', _fastest_key)):
+            old = board[name]
+            entries = sorted([e for e in old if e['user_id'] not in user_ids] + fresh[name], key=key)[:size]
+            # A full list whose cut-off got worse may now admit a user it never stored
+            if len(old) == size and (len(entries) < size or key(entries[-1]) > key(old[-1])):
+                return False
+            merged[name] = entries
+
+        try:
+            result = mongo.db.leaderboards.update_one(
+                {'_id': scope, 'version': board['version']},
+                {'$set': {**merged, 'updated_at': now}, '$inc': {'version': 1}},
+                upsert=board['version'] == 0
+            )
+        except DuplicateKeyError:
+            continue
+        if result.matched_count or result.upserted_id is not None:
+            return True
+    return False
+
+
+def refresh_users(user_ids):
+    """Recompute the leaderboard entries of ``user_ids`` after their past results changed (a regrade).
+
+    Only these users' history is read; a board is rebuilt from the whole
+    history only when one of them dropped out of a full top K.
+    """
+    now = datetime.utcnow()
+    user_ids = set(user_ids)
+    usernames = {u['_id']: u['username'] for u in mongo.db.users.find(
+        {'_id': {'$in': list(user_ids)}}, {'username': 1})}
+    boards, recents = _scan(_history({'user_id': {'$in': list(user_ids)}}), usernames)
+
+    scopes = set(boards) | {b['_id'] for b in mongo.db.leaderboards.find(
+        {'$or': [{'best.user_id': {'$in': list(user_ids)}}, {'fastest.user_id': {'$in': list(user_ids)}}]},
+        {'_id': 1})}
+    stale = [scope for scope in scopes
+             if not _refresh_board(scope, user_ids, boards.get(scope, {'best': [], 'fastest': []}), now)]
+    _set_recents(recents, usernames, now)
+
+    if stale:
+        usernames = {u['_id']: u['username'] for u in mongo.db.users.find({}, {'username': 1})}
+        for scope in stale:
+            query = {} if scope == ALL else {'subject_id': ObjectId(scope)}
+            board, _ = _scan(_history(query), usernames, only=scope)
+            _set_board(scope, board.get(scope, {'best': [], 'fastest': []}), now)
+
+    with _lock:
+        _boards.clear()
@@ -0,0 +1,144 @@
+"""Per-user question mastery and adaptive practice selection.
+
+Mastery is stored as one ``mastery`` document per (user, subject) mapping
+question ids to compact counters: ``a`` attempts, ``c`` correct answers,
+``s`` current streak of correct answers and ``t`` last seen (epoch seconds).
+It is updated from graded exams with a single ``bulk_write``.
+
+Practice exams are drawn by weighted sampling without replacement over the
+whole question bank of the subject. Weak questions (low smoothed accuracy) and
+questions due for review (last seen longer ago than an interval that doubles
+with each correct answer in a row) weigh the most; mastered ones rarely come
+back. Selection is one read of the mastery documents plus NumPy work over the
+cached question ids, whatever the size of the bank.
+"""
+import time
+from collections import defaultdict
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app import mongo
+from app.cache import cache
+
+REVIEW_INTERVAL = 24 * 3600  # seconds before a question answered once correctly is due again
+MAX_STREAK = 10
+MAX_OVERDUE = 4.0
+UNSEEN_OVERDUE = 0.5  # unseen questions rank just below weak ones seen recently
+MIN_WEIGHT = 0.01
+
+
+def _doc_id(user_id, subject_id):
+    return f'{user_id}:{subject_id or "none"}'
+
+
+def record_attempts(user_id, graded):
+    """Update mastery from ``graded``, an iterable of (question_id, subject_id, is_correct)."""
+    now = int(time.time())
+    updates = defaultdict(lambda: {'$inc': {}, '$set': {}})
+
+    for question_id, subject_id, is_correct in graded:
+        update = updates[subject_id]
+        prefix = f'items.{question_id}'
+        update['$inc'][f'{prefix}.a'] = 1
+        update['$inc'][f'{prefix}.c'] = int(is_correct)
+        update['$set'][f'{prefix}.t'] = now
+        if is_correct:
+            update['$inc'][f'{prefix}.s'] = 1
+        else:
+            update['$set'][f'{prefix}.s'] = 0
+
+    if not updates:
+        return
+
+    requests = []
+    for subject_id, update in updates.items():
+        update['$setOnInsert'] = {'user_id': ObjectId(user_id), 'subject_id': subject_id}
+        requests.append(UpdateOne({'_id': _doc_id(user_id, subject_id)}, update, upsert=True))
+    mongo.db.mastery.bulk_write(requests, ordered=False)
+
+
+def _question_ids(subject_id):
+    """Cached (ids, positions) for the bank of ``subject_id`` (all subjects when None)."""
+    def load_all():
+        banks = defaultdict(list)
+        for q in mongo.db.questions.find({}, {'_id': 1, 'subject_id': 1}):
+            banks[str(q.get('subject_id'))].append(str(q['_id']))
+        return dict(banks)
+
+    def load():
+        banks = cache.get('question_ids', load_all, tag='questions')
+        if subject_id:
+            ids = banks.get(str(subject_id), [])
+        else:
+            ids = [qid for bank in banks.values() for qid in bank]
+        ids = np.array(ids, dtype=object)
+        return ids, {qid: i for i, qid in enumerate(ids)}
+
+    return cache.get(f'question_ids:{subject_id or "all"}', load, tag='questions')
+
+
+def _mastery_items(user_id, subject_id):
+    if subject_id:
+        doc = mongo.db.mastery.find_one({'_id': _doc_id(user_id, ObjectId(subject_id))}, {'items': 1})
+        return doc.get('items', {}) if doc else {}
+
+    items = {}
+    for doc in mongo.db.mastery.find({'user_id': ObjectId(user_id)}, {'items': 1}):
+        items.update(doc.get('items', {}))
+    return items
+
+
+def weights(attempts, correct, streak, last_seen, now):
+    """Sampling weight per question; arrays are aligned, unseen questions have attempts == 0."""
+    accuracy = (correct + 1) / (attempts + 2)
+    interval = REVIEW_INTERVAL * np.exp2(np.minimum(streak, MAX_STREAK))
+    overdue = np.where(attempts > 0, (now - last_seen) / interval, UNSEEN_OVERDUE)
+    overdue = np.clip(overdue, 0.0, MAX_OVERDUE)
+    return (1 - accuracy) * (1 + overdue) + MIN_WEIGHT
+
+
+def select_questions(user_id, limit, subject_id=None, rng=None):
+    """Pick ``limit`` questions for a practice exam, favoring weak and due ones."""
+    ids, positions = _question_ids(subject_id)
+    if len(ids) == 0:
+        return []
+
+    n = len(ids)
+    attempts = np.zeros(n)
+    correct = np.zeros(n)
+    streak = np.zeros(n)
+    last_seen = np.zeros(n)
+    for qid, item in _mastery_items(user_id, subject_id).items():
+        i = positions.get(qid)
+        if i is not None:
+            attempts[i] = item.get('a', 0)
+            correct[i] = item.get('c', 0)
+            streak[i] = item.get('s', 0)
+            last_seen[i] = item.get('t', 0)
+
+    w = weights(attempts, correct, streak, last_seen, time.time())
+
+    # Weighted sampling without replacement (Efraimidis-Spirakis): keep the
+    # largest log(u) / w keys.
+    rng = rng or np.random.default_rng()
+    keys = np.log(rng.random(n)) / w
+    k = min(max(limit, 1), n)
+    chosen = np.argpartition(-keys, k - 1)[:k]
+    chosen = chosen[np.argsort(-keys[chosen])]
+
+    order = [ObjectId(qid) for qid in ids[chosen]]
+    found = {q['_id']: q for q in mongo.db.questions.find({'_id': {'$in': order}})}
+    return [found[qid] for qid in order if qid in found]
+
+
+def adjust_correct(question_id, subject_id, deltas):
+    """Shift the correct-answer counters of ``question_id`` by ``deltas`` ({user_id: +-n}) after a regrade."""
+    requests = [
+        UpdateOne({'_id': _doc_id(user_id, subject_id), f'items.{question_id}': {'$exists': True}},
+                  {'$inc': {f'items.{question_id}.c': delta}})
+        for user_id, delta in deltas.items() if delta
+    ]
+    if requests:
+        mongo.db.mastery.bulk_write(requests, ordered=False)
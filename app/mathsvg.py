@@ -0,0 +1,106 @@
+"""Server-side pre-rendering of ``$...$`` formulas to SVG.
+
+Formulas are rendered once, at import or edit time, with matplotlib mathtext
+into a content-addressed cache ``<UPLOAD_FOLDER>/math/<ab>/<sha256>.svg``, so a
+formula shared by many questions is rendered and downloaded once. Questions
+store the hashes of their rendered formulas in ``math``; the ``math_html``
+template filter swaps those formulas for ``<img>`` tags and leaves the others
+as ``$...$`` for MathJax to typeset in the browser; MathJax is only loaded on
+pages that have such formulas.
+"""
+import hashlib
+import io
+import os
+import re
+
+from flask import g, url_for
+from markupsafe import Markup, escape
+
+from app.assets import compress_file
+
+MATH_RE = re.compile(r'\$([^$]+)\$')
+FONT_SIZE = 14
+
+
+def formula_hash(tex):
+    return hashlib.sha256(tex.strip().encode('utf-8')).hexdigest()
+
+
+def svg_path(folder, digest):
+    return os.path.join(folder, 'math', digest[:2], f'{digest}.svg')
+
+
+def render(tex, folder):
+    """Render one formula into the cache; return its hash, or None if mathtext cannot parse it."""
+    digest = formula_hash(tex)
+    path = svg_path(folder, digest)
+    if os.path.isfile(path):
+        return digest
+    if os.path.isfile(path + '.fail'):
+        return None
+
+    from matplotlib import mathtext
+    from matplotlib.font_manager import FontProperties
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    buf = io.BytesIO()
+    try:
+        mathtext.math_to_image(f'${tex.strip()}$', buf, prop=FontProperties(size=FONT_SIZE), format='svg')
+    except Exception:
+        # Remember the failure so later imports do not retry it
+        open(path + '.fail', 'w').close()
+        return None
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(buf.getvalue())
+    os.replace(tmp, path)
+    compress_file(path)
+    return digest
+
+
+def prerender(texts, folder):
+    """Render every formula found in ``texts``; return the sorted hashes that succeeded."""
+    digests = set()
+    for text in texts:
+        for match in MATH_RE.finditer(text or ''):
+            digest = render(match.group(1), folder)
+            if digest:
+                digests.add(digest)
+    return sorted(digests)
+
+
+def question_texts(question):
+    return [question.get('question')] + list((question.get('options') or {}).values())
+
+
+def math_html(text, rendered=None):
+    """Template filter: escape ``text`` and replace the formulas in ``rendered`` with SVG images.
+
+    ``rendered`` is the question's stored ``math`` list, so rendering a page
+    never touches the disk. Other formulas are left for MathJax, which the
+    base template then loads (``g.math_fallback``).
+    """
+    if not text:
+        return ''
+    if '$' not in text:
+        return escape(text)
+    if not rendered:
+        if MATH_RE.search(text):
+            g.math_fallback = True
+        return escape(text)
+
+    parts = []
+    last = 0
+    for match in MATH_RE.finditer(text):
+        parts.append(escape(text[last:match.start()]))
+        digest = formula_hash(match.group(1))
+        if digest in rendered:
+            parts.append(Markup('<img class="math" src="{}" alt="{}">').format(
+                url_for('main.math_svg', digest=digest), match.group(0)))
+        else:
+            g.math_fallback = True
+            parts.append(escape(match.group(0)))
+        last = match.end()
+    parts.append(escape(text[last:]))
+    return Markup('').join(parts)
@@ -0,0 +1,217 @@
+"""Request timing and MongoDB command instrumentation.
+
+Latency histograms, DB command counts and DB time are aggregated per endpoint
+in process memory and exported in Prometheus text format on ``/metrics``, which
+only answers scrapers presenting ``METRICS_TOKEN`` and is closed when no token
+is configured. Per-request timings are sent in a ``Server-Timing`` header only
+when ``METRICS_SERVER_TIMING`` is on.
+"""
+import hmac
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, current_app, request
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_CALL_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class _RequestStats(threading.local):
+    """Counters for the request currently handled by this thread."""
+
+    def __init__(self):
+        self.active = False
+        self.start = 0.0
+        self.status = 500
+        self.db_calls = 0
+        self.db_time = 0.0
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class CommandTimer(monitoring.CommandListener):
+    """PyMongo listener feeding command durations into a Metrics instance."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.record_command(event.command_name, event.duration_micros / 1e6, 'success')
+
+    def failed(self, event):
+        self.metrics.record_command(event.command_name, event.duration_micros / 1e6, 'failure')
+
+
+class Metrics:
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._local = _RequestStats()
+        self.command_listener = CommandTimer(self)
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_SERVER_TIMING', False)
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+
+    def reset(self):
+        with self._lock:
+            self._latency = {}
+            self._db_calls = {}
+            self._db_time = {}
+            self._requests = {}
+            self._commands = {}
+            self._command_time = {}
+
+    # Recording
+
+    def record_command(self, name, seconds, outcome='success'):
+        stats = self._local
+        if stats.active:
+            stats.db_calls += 1
+            stats.db_time += seconds
+
+        with self._lock:
+            key = (name, outcome)
+            self._commands[key] = self._commands.get(key, 0) + 1
+            self._command_time[name] = self._command_time.get(name, 0.0) + seconds
+
+    def current_request(self):
+        """Return (db_calls, db_seconds) accumulated so far by this thread's request."""
+        stats = self._local
+        return stats.db_calls, stats.db_time
+
+    def _before_request(self):
+        stats = self._local
+        stats.active = True
+        stats.start = time.perf_counter()
+        stats.status = 500
+        stats.db_calls = 0
+        stats.db_time = 0.0
+
+    def _after_request(self, response):
+        stats = self._local
+        if stats.active:
+            stats.status = response.status_code
+            if not current_app.config['METRICS_SERVER_TIMING']:
+                return response
+            elapsed = time.perf_counter() - stats.start
+            response.headers['Server-Timing'] = (
+                f'app;dur={elapsed * 1000:.1f}, '
+                f'db;dur={stats.db_time * 1000:.1f};desc="{stats.db_calls} queries"'
+            )
+        return response
+
+    def _teardown_request(self, exc=None):
+        # Runs once the response body has been sent, so streamed responses
+        # are measured in full.
+        stats = self._local
+        if not stats.active:
+            return
+        stats.active = False
+
+        elapsed = time.perf_counter() - stats.start
+        endpoint = request.endpoint or 'unmatched'
+        route = (endpoint, request.method)
+
+        with self._lock:
+            latency = self._latency.get(route)
+            if latency is None:
+                latency = self._latency[route] = _Histogram(LATENCY_BUCKETS)
+                self._db_calls[route] = _Histogram(DB_CALL_BUCKETS)
+            latency.observe(elapsed)
+            self._db_calls[route].observe(stats.db_calls)
+            self._db_time[route] = self._db_time.get(route, 0.0) + stats.db_time
+
+            key = route + (stats.status,)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    # Export
+
+    def _metrics_view(self):
+        token = current_app.config.get('METRICS_TOKEN')
+        if not token:
+            return Response('Metrics are disabled: set METRICS_TOKEN\n', status=403, mimetype='text/plain')
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def render(self):
+        lines = []
+        with self._lock:
+            self._render_histograms(
+                lines, 'http_request_duration_seconds',
+                'Request latency in seconds by endpoint.', self._latency)
+            self._render_histograms(
+                lines, 'http_request_db_calls',
+                'MongoDB commands issued per request by endpoint.', self._db_calls)
+
+            lines.append('# HELP http_request_db_seconds_total Time spent in MongoDB commands by endpoint.')
+            lines.append('# TYPE http_request_db_seconds_total counter')
+            for (endpoint, method), value in sorted(self._db_time.items()):
+                lines.append(f'http_request_db_seconds_total{_labels(endpoint=endpoint, method=method)} {value:.6f}')
+
+            lines.append('# HELP http_requests_total Requests handled by endpoint and status.')
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, method, status), value in sorted(self._requests.items()):
+                lines.append(f'http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {value}')
+
+            lines.append('# HELP mongodb_commands_total MongoDB commands by name and outcome.')
+            lines.append('# TYPE mongodb_commands_total counter')
+            for (name, outcome), value in sorted(self._commands.items()):
+                lines.append(f'mongodb_commands_total{_labels(command=name, outcome=outcome)} {value}')
+
+            lines.append('# HELP mongodb_command_seconds_total Time spent in MongoDB commands by name.')
+            lines.append('# TYPE mongodb_command_seconds_total counter')
+            for name, value in sorted(self._command_time.items()):
+                lines.append(f'mongodb_command_seconds_total{_labels(command=name)} {value:.6f}')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histograms(lines, name, help_text, histograms):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for (endpoint, method), hist in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(endpoint=endpoint, method=method, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(endpoint=endpoint, method=method)} {hist.sum:.6f}')
+            lines.append(f'{name}_count{_labels(endpoint=endpoint, method=method)} {hist.count}')
+
+
+def _labels(**labels):
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
@@ -0,0 +1,195 @@
+"""Versioned, resumable data migrations.
+
+Migrations are registered in order with ``@migration('<id>')`` and recorded
+in the ``migrations`` collection once applied, so ``migrate()`` only runs the
+pending ones. The docstring of a migration is its description.
+
+Data is rewritten with ``MigrationRun.backfill``: it walks a collection in
+``_id`` order, ``batch_size`` documents at a time, and pauses between chunks
+so a large collection is migrated online without long-running writes. The
+last ``_id`` of every chunk is checkpointed, so an interrupted or failed run
+resumes where it stopped. A lease on the migration document keeps two
+runners from applying the same migration at once.
+
+    python migrate.py             # apply pending migrations
+    python migrate.py --status
+"""
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from app import mongo
+from app.cache import cache
+from app.mathsvg import prerender, question_texts
+from app.models import Subject
+
+BATCH_SIZE = 1000
+PAUSE = 0.05  # seconds between chunks
+LEASE = timedelta(minutes=5)
+
+_registry = []
+
+
+class MigrationLocked(RuntimeError):
+    pass
+
+
+def migration(migration_id):
+    """Register the decorated function as migration ``migration_id``."""
+    def register(func):
+        if any(mid == migration_id for mid, _ in _registry):
+            raise ValueError(f'Duplicate migration id {migration_id}')
+        _registry.append((migration_id, func))
+        _registry.sort(key=lambda m: m[0])
+        return func
+    return register
+
+
+def _description(func):
+    return (func.__doc__ or func.__name__).strip().splitlines()[0]
+
+
+class MigrationRun:
+    def __init__(self, migration_id, batch_size=BATCH_SIZE, pause=PAUSE, log=None):
+        self.migration_id = migration_id
+        self.batch_size = batch_size
+        self.pause = pause
+        self.log = log or (lambda message: None)
+        self.checkpoints = {}
+        self.processed = {}
+
+    def acquire(self, description):
+        now = datetime.utcnow()
+        try:
+            doc = mongo.db.migrations.find_one_and_update(
+                {'_id': self.migration_id, 'status': {'$ne': 'done'}, 'lease_until': None},
+                {'$set': {'status': 'running', 'description': description, 'lease_until': now + LEASE},
+                 '$setOnInsert': {'started_at': now, 'checkpoints': {}, 'processed': {}}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            doc = mongo.db.migrations.find_one_and_update(
+                {'_id': self.migration_id, 'status': {'$ne': 'done'}, 'lease_until': {'$lt': now}},
+                {'$set': {'status': 'running', 'lease_until': now + LEASE}},
+                return_document=ReturnDocument.AFTER)
+            if doc is None:
+                raise MigrationLocked(f'{self.migration_id} is already running or applied')
+        self.checkpoints = doc.get('checkpoints', {})
+        self.processed = doc.get('processed', {})
+        if self.checkpoints:
+            self.log(f'{self.migration_id}: resuming from checkpoint')
+
+    def _checkpoint(self, step, last_id):
+        self.checkpoints[step] = last_id
+        mongo.db.migrations.update_one({'_id': self.migration_id}, {'$set': {
+            f'checkpoints.{step}': last_id,
+            f'processed.{step}': self.processed[step],
+            'lease_until': datetime.utcnow() + LEASE,
+        }})
+
+    def _release(self, **fields):
+        fields['lease_until'] = None
+        mongo.db.migrations.update_one({'_id': self.migration_id}, {'$set': fields})
+
+    def backfill(self, collection, query, update, projection=None, step=None):
+        """Apply ``update`` to the documents of ``collection`` matching ``query``, chunk by chunk.
+
+        ``update`` is an update document applied to the whole chunk, or a
+        function returning the update for one document (or None to skip it);
+        ``projection`` selects the fields that function needs. ``step`` names
+        the checkpoint when a migration walks the same collection twice.
+        Returns the number of documents processed.
+        """
+        step = step or collection
+        coll = mongo.db[collection]
+        last_id = self.checkpoints.get(step)
+        self.processed.setdefault(step, 0)
+
+        while True:
+            chunk_query = dict(query)
+            if last_id is not None:
+                chunk_query['_id'] = {'$gt': last_id}
+            docs = list(coll.find(chunk_query, projection or {'_id': 1}, sort=[('_id', 1)], limit=self.batch_size))
+            if not docs:
+                return self.processed[step]
+
+            if callable(update):
+                requests = []
+                for doc in docs:
+                    doc_update = update(doc)
+                    if doc_update:
+                        requests.append(UpdateOne({'_id': doc['_id']}, doc_update))
+                if requests:
+                    coll.bulk_write(requests, ordered=False)
+            else:
+                coll.update_many({**query, '_id': {'$in': [d['_id'] for d in docs]}}, update)
+
+            last_id = docs[-1]['_id']
+            self.processed[step] += len(docs)
+            self._checkpoint(step, last_id)
+            self.log(f'{self.migration_id} {step}: {self.processed[step]} documents')
+            if self.pause:
+                time.sleep(self.pause)
+
+
+def status():
+    """Every registered migration with its description and record, if any."""
+    records = {doc['_id']: doc for doc in mongo.db.migrations.find()}
+    return [(mid, _description(func), records.get(mid)) for mid, func in _registry]
+
+
+def pending():
+    return [mid for mid, _, record in status() if not record or record.get('status') != 'done']
+
+
+def migrate(batch_size=BATCH_SIZE, pause=PAUSE, log=None):
+    """Apply the pending migrations in order; return the ids applied."""
+    log = log or (lambda message: None)
+    todo = set(pending())
+    applied = []
+    for migration_id, func in _registry:
+        if migration_id not in todo:
+            continue
+        run = MigrationRun(migration_id, batch_size, pause, log)
+        log(f'{migration_id}: {_description(func)}')
+        run.acquire(_description(func))
+        try:
+            func(run)
+        except Exception as e:
+            run._release(status='failed', error=str(e))
+            raise
+        run._release(status='done', error=None, finished_at=datetime.utcnow())
+        applied.append(migration_id)
+    return applied
+
+
+# --- Migrations ------------------------------------------------------------
+
+DEFAULT_SUBJECT_NAME = "Thủy văn công trình"
+
+
+@migration('0001_default_subject')
+def create_default_subject(run):
+    """Create the default subject"""
+    if not mongo.db.subjects.find_one({'name': DEFAULT_SUBJECT_NAME}):
+        Subject.create(name=DEFAULT_SUBJECT_NAME, description="Môn học mặc định")
+
+
+@migration('0002_subject_ids')
+def assign_default_subject(run):
+    """Assign questions and exam results without a subject to the default subject"""
+    subject_id = mongo.db.subjects.find_one({'name': DEFAULT_SUBJECT_NAME})['_id']
+    for collection in ('questions', 'exam_results'):
+        run.backfill(collection, {'subject_id': {'$exists': False}}, {'$set': {'subject_id': subject_id}})
+    cache.invalidate('questions')
+
+
+@migration('0003_prerender_math')
+def prerender_question_math(run):
+    """Pre-render the formulas of questions created before math pre-rendering"""
+    folder = current_app.config['UPLOAD_FOLDER']
+    run.backfill('questions', {'math': {'$exists': False}},
+                 lambda q: {'$set': {'math': prerender(question_texts(q), folder)}},
+                 projection={'question': 1, 'options': 1})
@@ -1,8 +1,26 @@
 from datetime import datetime
+from flask import g
 from flask_login import UserMixin
 from app import mongo
+from app.cache import cache
 from bson import ObjectId
 
+
+def ensure_indexes():
+    """Create the indexes the application relies on (idempotent)."""
+    mongo.db.leaderboard_recent.create_index([('scope', 1), ('average', -1), ('count', -1)])
+    mongo.db.mastery.create_index('user_id')
+    mongo.db.questions.create_index([('question', 'hashed')])
+    mongo.db.exam_results.create_index([('user_id', 1), ('completed_at', -1)])
+    mongo.db.exam_results.create_index('completed_at')
+    mongo.db.exam_results.create_index('answers.question_id')
+    mongo.db.exam_results_archive.create_index([('user_id', 1), ('completed_at', -1)])
+    mongo.db.exam_results_archive.create_index('answers.question_id')
+    mongo.db.exam_results_archive.create_index('rolled_up', sparse=True)
+    mongo.db.exam_rollups.create_index([('user_id', 1), ('month', -1)])
+    mongo.db.regrade_jobs.create_index('status')
+    mongo.db.exam_sessions.create_index('expires_at', expireAfterSeconds=0)
+
 class User(UserMixin):
     def __init__(self, user_data):
         self.id = str(user_data['_id'])
@@ -34,18 +52,36 @@ class User(UserMixin):
 class Subject:
     @staticmethod
     def create(name, description=""):
-        return mongo.db.subjects.insert_one({
+        result = mongo.db.subjects.insert_one({
             'name': name,
             'description': description,
             'created_at': datetime.utcnow()
         })
+        cache.invalidate('subjects')
+        return result
     
     @staticmethod
-    def get_all():
+    def _load_all():
         return list(mongo.db.subjects.find({}, sort=[('name', 1)]))
     
+    @staticmethod
+    def get_all():
+        # Copies, since callers decorate the documents for their templates
+        return [dict(s) for s in cache.get('subjects', Subject._load_all)]
+    
+    @staticmethod
+    def get_map():
+        """Cached {str(_id): subject} lookup, read-only."""
+        return cache.get('subjects_by_id',
+                         lambda: {str(s['_id']): s for s in cache.get('subjects', Subject._load_all)},
+                         tag='subjects')
+    
     @staticmethod
     def get(subject_id):
+        subject = Subject.get_map().get(str(subject_id))
+        if subject:
+            return dict(subject)
+        # Possibly created by another worker since our last cache sync
         try:
             return mongo.db.subjects.find_one({'_id': ObjectId(subject_id)})
         except:
@@ -53,10 +89,12 @@ class Subject:
             
     @staticmethod
     def update(subject_id, name, description=""):
-        return mongo.db.subjects.update_one(
+        result = mongo.db.subjects.update_one(
             {'_id': ObjectId(subject_id)},
             {'$set': {'name': name, 'description': description, 'updated_at': datetime.utcnow()}}
         )
+        cache.invalidate('subjects')
+        return result
         
     @staticmethod
     def delete(subject_id):
@@ -66,11 +104,12 @@ class Subject:
             return False, f"Không thể xóa môn học này vì đang có {count} câu hỏi."
             
         mongo.db.subjects.delete_one({'_id': ObjectId(subject_id)})
+        cache.invalidate('subjects')
         return True, ""
         
     @staticmethod
     def count_questions(subject_id):
-        return mongo.db.questions.count_documents({'subject_id': ObjectId(subject_id)})
+        return Question.get_counts().get(str(subject_id), 0)
 
 class Question:
     @staticmethod
@@ -87,7 +126,14 @@ class Question:
         if subject_id:
             data['subject_id'] = ObjectId(subject_id)
             
-        return mongo.db.questions.insert_one(data)
+        result = mongo.db.questions.insert_one(data)
+        Question.invalidate_cache()
+        return result
+    
+    @staticmethod
+    def invalidate_cache():
+        """Call after any write to the questions collection."""
+        cache.invalidate('questions')
     
     @staticmethod
     def get_all():
@@ -110,16 +156,28 @@ class Question:
         pipeline.append({'$sample': {'size': limit}})
         return list(mongo.db.questions.aggregate(pipeline))
     
+    @staticmethod
+    def get_counts():
+        """Cached {str(subject_id): question count}, read-only."""
+        def load():
+            pipeline = [{'$group': {'_id': '$subject_id', 'count': {'$sum': 1}}}]
+            return {str(g['_id']): g['count'] for g in mongo.db.questions.aggregate(pipeline)}
+        return cache.get('question_counts', load, tag='questions')
+    
+    @staticmethod
+    def get_categories():
+        return cache.get('categories', lambda: mongo.db.questions.distinct('category'), tag='questions')
+    
     @staticmethod
     def count(subject_id=None):
-        query = {}
+        counts = Question.get_counts()
         if subject_id:
-            query['subject_id'] = ObjectId(subject_id)
-        return mongo.db.questions.count_documents(query)
+            return counts.get(str(subject_id), 0)
+        return sum(counts.values())
 
 class ExamResult:
     @staticmethod
-    def create(user_id, score, total_questions, answers, duration_seconds, subject_id=None):
+    def create(user_id, score, total_questions, answers, duration_seconds, subject_id=None, result_id=None):
         data = {
             'user_id': ObjectId(user_id),
             'score': score,
@@ -132,6 +190,8 @@ class ExamResult:
         
         if subject_id:
             data['subject_id'] = ObjectId(subject_id)
+        if result_id:
+            data['_id'] = result_id
             
         return mongo.db.exam_results.insert_one(data)
     
@@ -146,9 +206,25 @@ class ExamResult:
                 
         return list(mongo.db.exam_results.find(
             query,
+            {'answers': 0},
             sort=[('completed_at', -1)]
         ))
     
+    @staticmethod
+    def get_rollups(user_id, subject_id=None):
+        """Monthly summaries of the user's archived results, newest month first."""
+        # One read per request: the home page asks once per subject
+        cache_key = f'rollups:{user_id}'
+        if cache_key not in g:
+            setattr(g, cache_key, list(mongo.db.exam_rollups.find(
+                {'user_id': ObjectId(user_id)},
+                sort=[('month', -1)]
+            )))
+        rollups = getattr(g, cache_key)
+        if subject_id:
+            rollups = [r for r in rollups if str(r.get('subject_id')) == str(subject_id)]
+        return rollups
+    
     @staticmethod
     def get_all_results():
         return list(mongo.db.exam_results.find())
@@ -156,14 +232,25 @@ class ExamResult:
     @staticmethod
     def get_user_stats(user_id, subject_id=None):
         results = ExamResult.get_user_results(user_id, subject_id)
-        if not results:
+        rollups = ExamResult.get_rollups(user_id, subject_id)
+        if not results and not rollups:
             return None
         
-        total_exams = len(results)
-        average_score = sum(r['percentage'] for r in results) / total_exams if total_exams > 0 else 0
-        best_score = max(r['percentage'] for r in results)
-        worst_score = min(r['percentage'] for r in results)
-        total_time = sum(r['duration_seconds'] for r in results)
+        # Archived results only survive as monthly rollups
+        total_exams = len(results) + sum(r['count'] for r in rollups)
+        percentage_sum = sum(r['percentage'] for r in results) + sum(r['percentage_sum'] for r in rollups)
+        average_score = percentage_sum / total_exams if total_exams > 0 else 0
+        best_score = max([r['percentage'] for r in results] + [r['best'] for r in rollups])
+        worst_score = min([r['percentage'] for r in results] + [r['worst'] for r in rollups])
+        total_time = sum(r['duration_seconds'] for r in results) + sum(r['duration_seconds'] for r in rollups)
+        
+        last_10_scores = [r['percentage'] for r in results[:10]]
+        if len(last_10_scores) < 10 and rollups:
+            query = {'user_id': ObjectId(user_id)}
+            if subject_id:
+                query['subject_id'] = ObjectId(subject_id)
+            last_10_scores += [r['percentage'] for r in mongo.db.exam_results_archive.find(
+                query, {'percentage': 1}, sort=[('completed_at', -1)], limit=10 - len(last_10_scores))]
         
         return {
             'total_exams': total_exams,
@@ -171,5 +258,5 @@ class ExamResult:
             'best_score': best_score,
             'worst_score': worst_score,
             'total_time': total_time,
-            'last_10_scores': [r['percentage'] for r in results[:10]]
+            'last_10_scores': last_10_scores
         }
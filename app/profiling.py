@@ -0,0 +1,190 @@
+"""On-demand sampling profiler for live requests.
+
+A fraction of requests (optionally restricted to one endpoint) is profiled by
+a single background thread that periodically snapshots the stack of each
+profiled request thread. Samples are written per endpoint as collapsed-stack
+files (``frame;frame;frame count``, the flamegraph.pl input format) into a
+rolling directory, and summarised into a hot-function table for the admin page.
+"""
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request
+
+
+class StackSampler:
+    """Samples the Python stacks of registered threads at a fixed interval."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._targets = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._labels = {}
+
+    def start(self, ident):
+        with self._cond:
+            self._targets[ident] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def stop(self, ident):
+        with self._cond:
+            return self._targets.pop(ident, Counter())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._targets:
+                    self._cond.wait()
+            time.sleep(self.interval)
+
+            frames = sys._current_frames()
+            with self._cond:
+                for ident, counter in self._targets.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counter[self._stack(frame)] += 1
+
+    def _stack(self, frame):
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = f'{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})'
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels)
+
+
+class Profiler:
+    def __init__(self, app=None):
+        self._local = threading.local()
+        self.sampler = StackSampler()
+        self.rate = 0.0
+        self.endpoint = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_FOLDER', 'profiles')
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_ENDPOINT', None)
+        app.config.setdefault('PROFILE_INTERVAL', 0.005)
+        app.config.setdefault('PROFILE_MAX_FILES', 50)
+
+        self.folder = app.config['PROFILE_FOLDER']
+        self.max_files = app.config['PROFILE_MAX_FILES']
+        self.sampler.interval = app.config['PROFILE_INTERVAL']
+        self.configure(app.config['PROFILE_SAMPLE_RATE'], app.config['PROFILE_ENDPOINT'])
+
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def configure(self, rate, endpoint=None):
+        """Change the sampled fraction of requests and the endpoint filter at runtime."""
+        rate = float(rate)
+        if not math.isfinite(rate):
+            raise ValueError(f'Invalid sample rate {rate}')
+        self.rate = min(max(rate, 0.0), 1.0)
+        self.endpoint = endpoint or None
+
+    def _before_request(self):
+        self._local.active = False
+        if self.rate <= 0:
+            return
+        if self.endpoint and request.endpoint != self.endpoint:
+            return
+        if random.random() >= self.rate:
+            return
+
+        self._local.active = True
+        self._local.start = time.time()
+        self.sampler.start(threading.get_ident())
+
+    def _teardown_request(self, exc=None):
+        if not getattr(self._local, 'active', False):
+            return
+        self._local.active = False
+
+        samples = self.sampler.stop(threading.get_ident())
+        if samples:
+            self._write(request.endpoint or 'unmatched', samples)
+
+    def _write(self, endpoint, samples):
+        folder = os.path.join(self.folder, endpoint)
+        os.makedirs(folder, exist_ok=True)
+
+        start = self._local.start
+        name = time.strftime('%Y%m%d-%H%M%S', time.localtime(start)) + f'.{int(start % 1 * 1e6):06d}'
+        path = os.path.join(folder, f'{name}-{threading.get_ident()}.collapsed')
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in samples.items():
+                f.write(f'{stack} {count}\n')
+
+        files = sorted(os.listdir(folder))
+        for old in files[:-self.max_files]:
+            try:
+                os.remove(os.path.join(folder, old))
+            except OSError:
+                pass
+
+    def endpoints(self):
+        """Endpoints that have profile files on disk."""
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(d for d in os.listdir(self.folder) if os.path.isdir(os.path.join(self.folder, d)))
+
+    def summarize(self, endpoint, limit=30, sort='self'):
+        """Aggregate the stored profiles of ``endpoint`` into a hot-function table.
+
+        ``self`` counts samples where the function was on top of the stack,
+        ``total`` counts samples where it appeared anywhere in the stack.
+        """
+        folder = os.path.join(self.folder, endpoint)
+        self_counts = Counter()
+        total_counts = Counter()
+        samples = 0
+        files = 0
+
+        for name in os.listdir(folder) if os.path.isdir(folder) else []:
+            files += 1
+            with open(os.path.join(folder, name), encoding='utf-8') as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    count = int(count)
+                    frames = stack.split(';')
+                    samples += count
+                    self_counts[frames[-1]] += count
+                    for frame in set(frames):
+                        total_counts[frame] += count
+
+        rows = []
+        for function, total in total_counts.most_common():
+            rows.append({
+                'function': function,
+                'self': self_counts[function],
+                'total': total,
+                'self_pct': self_counts[function] / samples * 100,
+                'total_pct': total / samples * 100,
+            })
+        if sort == 'self':
+            rows.sort(key=lambda r: (r['self'], r['total']), reverse=True)
+
+        return {'files': files, 'samples': samples, 'functions': rows[:limit]}
+
+
+def _short_path(filename):
+    for prefix in sorted(sys.path, key=len, reverse=True):
+        if prefix and filename.startswith(prefix + os.sep):
+            return filename[len(prefix) + 1:]
+    return filename
@@ -0,0 +1,200 @@
+"""Background regrading of stored exam results after an answer key change.
+
+``start()`` records a ``regrade_jobs`` document and hands it to a background
+thread. The thread finds the affected results, live and archived, through the
+``answers.question_id`` indexes, recomputes them in batches and applies each
+batch with one ``bulk_write``, updating the job's progress as it goes. Then it
+brings the derived data in line: mastery counters, monthly rollups of archived
+results and the leaderboard entries of the users whose scores changed.
+
+Jobs run one at a time and always grade against the question's current key,
+so two quick edits of the same question end with the results matching the
+last one.
+
+Every batch update doubles as a heartbeat on ``updated_at``. A job whose
+process died stops beating; once its lease has run out ``resume_stale()``
+(at startup, on the next ``start()`` or when its status is polled) runs it
+again. Regrading skips results that already match the key, and the mastery
+deltas, rollup months and ids of the batch being written are recorded on the
+job before the batch itself, so a resumed job counts each change once.
+"""
+import threading
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from flask import current_app
+from pymongo import ReturnDocument, UpdateOne
+
+from app import leaderboard, mastery, mongo
+from app.archive import month_start, refresh_rollups
+
+BATCH_SIZE = 500
+JOB_LEASE = timedelta(minutes=5)
+
+_lock = threading.Lock()
+
+
+def start(question_id):
+    """Queue a regrade of every result that answered ``question_id``; return the job id."""
+    resume_stale()
+    now = datetime.utcnow()
+    job_id = mongo.db.regrade_jobs.insert_one({
+        'question_id': ObjectId(question_id),
+        'status': 'queued',
+        'total': None,
+        'processed': 0,
+        'changed': 0,
+        'deltas': {},
+        'applied': {},
+        'months': [],
+        'pending': [],
+        'created_at': now,
+        'updated_at': now,
+    }).inserted_id
+    _spawn(job_id)
+    return str(job_id)
+
+
+def _spawn(job_id):
+    app = current_app._get_current_object()
+    thread = threading.Thread(target=_run, args=(app, job_id), name=f'regrade-{job_id}', daemon=True)
+    thread.start()
+
+
+def _stale_query():
+    return {'status': {'$in': ['queued', 'running']}, 'updated_at': {'$lt': datetime.utcnow() - JOB_LEASE}}
+
+
+def is_stale(job):
+    return job['status'] in ('queued', 'running') and job['updated_at'] < datetime.utcnow() - JOB_LEASE
+
+
+def resume_stale():
+    """Run again the jobs left queued or running by a process that stopped; return their ids."""
+    job_ids = [job['_id'] for job in mongo.db.regrade_jobs.find(_stale_query(), {'_id': 1}, sort=[('created_at', 1)])]
+    for job_id in job_ids:
+        _spawn(job_id)
+    return [str(job_id) for job_id in job_ids]
+
+
+def get_job(job_id):
+    try:
+        return mongo.db.regrade_jobs.find_one({'_id': ObjectId(job_id)})
+    except Exception:
+        return None
+
+
+def active_jobs():
+    return list(mongo.db.regrade_jobs.find({'status': {'$in': ['queued', 'running']}}, sort=[('created_at', 1)]))
+
+
+def _claim(job_id):
+    """Take ``job_id`` if it is queued or its runner stopped beating; None if it is done or running elsewhere."""
+    query = {'_id': job_id, '$or': [{'status': 'queued'}, _stale_query()]}
+    return mongo.db.regrade_jobs.find_one_and_update(
+        query, {'$set': {'status': 'running', 'updated_at': datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER)
+
+
+def _update_job(job_id, **fields):
+    fields['updated_at'] = datetime.utcnow()
+    mongo.db.regrade_jobs.update_one({'_id': job_id}, {'$set': fields})
+
+
+def _regrade_batch(job_id, collection, archived, batch, question_id, key, counted):
+    """Regrade ``batch``; results in ``counted`` had their deltas recorded by an earlier run."""
+    requests = []
+    ids = []
+    deltas = {}
+    months = []
+    for result in batch:
+        updates = {}
+        delta = 0
+        score = 0
+        for i, answer in enumerate(result.get('answers', [])):
+            if answer.get('question_id') == question_id:
+                is_correct = answer.get('user_answer') == key
+                if is_correct != answer.get('is_correct') or answer.get('correct_answer') != key:
+                    updates[f'answers.{i}.correct_answer'] = key
+                    updates[f'answers.{i}.is_correct'] = is_correct
+                if is_correct != answer.get('is_correct'):
+                    delta += 1 if is_correct else -1
+            else:
+                is_correct = answer.get('is_correct')
+            score += bool(is_correct)
+
+        if not updates:
+            continue
+        total = result.get('total_questions', 0)
+        updates['score'] = score
+        updates['percentage'] = (score / total) * 100 if total > 0 else 0
+        requests.append(UpdateOne({'_id': result['_id']}, {'$set': updates}))
+        ids.append(result['_id'])
+        if delta and result['_id'] not in counted:
+            uid = str(result['user_id'])
+            deltas[uid] = deltas.get(uid, 0) + delta
+        if archived:
+            months.append([result['user_id'], result.get('subject_id'), month_start(result['completed_at'])])
+
+    if not requests:
+        return 0
+    # Record the batch on the job first: if the write below is cut short, the
+    # resumed job still has these deltas and knows not to count them again.
+    record = {'$set': {'pending': list(counted.union(ids)), 'updated_at': datetime.utcnow()},
+              '$inc': {'changed': len(requests), **{f'deltas.{uid}': d for uid, d in deltas.items()}}}
+    if months:
+        record['$addToSet'] = {'months': {'$each': months}}
+    mongo.db.regrade_jobs.update_one({'_id': job_id}, record)
+    collection.bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def _run(app, job_id):
+    with app.app_context(), _lock:
+        job = _claim(job_id)
+        if job is None:
+            return
+        try:
+            question = mongo.db.questions.find_one({'_id': job['question_id']})
+            if question is None:
+                _update_job(job_id, status='failed', error='Câu hỏi không còn tồn tại')
+                return
+            question_id = str(question['_id'])
+            key = question['correct_answer']
+
+            query = {'answers.question_id': question_id}
+            collections = [(mongo.db.exam_results, False), (mongo.db.exam_results_archive, True)]
+            total = sum(c.count_documents(query) for c, _ in collections)
+            _update_job(job_id, total=total, processed=0, correct_answer=key)
+
+            counted = set(job.get('pending', []))
+            processed = 0
+            for collection, archived in collections:
+                batch = []
+                for result in collection.find(query, {'answers': 1, 'user_id': 1, 'subject_id': 1,
+                                                       'total_questions': 1, 'completed_at': 1}):
+                    batch.append(result)
+                    if len(batch) == BATCH_SIZE:
+                        _regrade_batch(job_id, collection, archived, batch, question_id, key, counted)
+                        processed += len(batch)
+                        batch = []
+                        _update_job(job_id, processed=processed)
+                if batch:
+                    _regrade_batch(job_id, collection, archived, batch, question_id, key, counted)
+                    processed += len(batch)
+                    _update_job(job_id, processed=processed)
+
+            job = mongo.db.regrade_jobs.find_one({'_id': job_id})
+            deltas = job.get('deltas', {})
+            applied = job.get('applied', {})
+            todo = {uid: d - applied.get(uid, 0) for uid, d in deltas.items()}
+            if any(todo.values()):
+                mastery.adjust_correct(question_id, question.get('subject_id'), todo)
+                _update_job(job_id, applied=deltas)
+            if job['changed']:
+                refresh_rollups({tuple(month) for month in job.get('months', [])})
+                leaderboard.refresh_users([ObjectId(uid) for uid, d in deltas.items() if d])
+            _update_job(job_id, status='done', processed=processed, pending=[])
+        except Exception as e:
+            app.logger.exception('Regrade job %s failed', job_id)
+            _update_job(job_id, status='failed', error=str(e))
@@ -1,7 +1,6 @@
 from docx import Document
-from datetime import datetime
 import re
-from app import mongo
+from app.images import paragraph_images
 from docx.oxml.ns import qn
 
 def clean_text(text):
@@ -96,20 +95,24 @@ def get_paragraph_text(paragraph):
         
     return "".join(text_parts)
 
-def import_from_docx(file, subject_id=None):
-    """Import questions from Word document"""
+def parse_docx(file, folder):
+    """Yield the questions of a Word document; embedded pictures are stored under ``folder``"""
     try:
         doc = Document(file)
     except Exception as e:
         raise Exception(f"Không thể đọc file Word: {str(e)}")
     
-    questions = []
     current_question = None
+    seen_images = {}
     
     for i, paragraph in enumerate(doc.paragraphs):
         text = get_paragraph_text(paragraph).strip()
+        images = paragraph_images(paragraph, folder, seen_images)
         
         if not text:
+            # Picture on its own line belongs to the question above it
+            if images and current_question:
+                current_question['images'].extend(images)
             continue
         
         # Detect question (starts with number followed by . or ) or a period, or starts with "Câu")
@@ -117,16 +120,17 @@ def import_from_docx(file, subject_id=None):
         
         if question_match:
             if current_question and current_question['question'] and current_question['correct_answer']:
-                questions.append(current_question)
+                yield current_question
             
-            question_text = question_match.group(2) if question_match.groups() > 1 else text
+            question_text = question_match.group(2) if len(question_match.groups()) > 1 else text
             
             current_question = {
                 'question': question_text.strip(),
                 'options': {},
                 'correct_answer': None,
                 'category': 'Thủy văn công trình',
-                'difficulty': 'medium'
+                'difficulty': 'medium',
+                'images': images
             }
         
         # Detect options (starts with a), b), c), d) or A., B., etc.)
@@ -137,6 +141,7 @@ def import_from_docx(file, subject_id=None):
                     option_key = match.group(1).lower()
                     option_text = match.group(2).strip()
                     current_question['options'][option_key] = option_text
+                current_question['images'].extend(images)
         
         # Detect correct answer (multiple formats)
         elif re.search(r'(Đáp án|Đáp Án|ĐÁP ÁN|Answer|ANSWER)[:\s]+([a-dA-D])', text, re.IGNORECASE):
@@ -151,31 +156,7 @@ def import_from_docx(file, subject_id=None):
     
     # Add the last question
     if current_question and current_question['question'] and current_question['correct_answer']:
-        questions.append(current_question)
-    
-    # Save to database
-    count = 0
-    for q in questions:
-        if q['question'] and q['options'] and q['correct_answer']:
-            # Check if question already exists
-            existing = mongo.db.questions.find_one({
-                'question': q['question'],
-                'correct_answer': q['correct_answer']
-            })
-            
-            if not existing:
-                mongo.db.questions.insert_one({
-                    'question': q['question'],
-                    'options': q['options'],
-                    'correct_answer': q['correct_answer'],
-                    'category': q['category'],
-                    'difficulty': q['difficulty'],
-                    'subject_id': ObjectId(subject_id) if subject_id else None,
-                    'created_at': datetime.utcnow()
-                })
-                count += 1
-    
-    return count
+        yield current_question
 
 def generate_sample_docx():
     """Generate a sample Word document with correct format"""
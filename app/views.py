@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, request, jsonify, flash, redirect, url_for
+from flask import Blueprint, render_template, request, jsonify, flash, redirect, url_for, current_app
 from flask_login import login_required, current_user
 from datetime import datetime
 import io
@@ -7,10 +7,17 @@ from matplotlib.figure import Figure
 import matplotlib
 matplotlib.use('Agg')  # Non-interactive backend
 
-from app import mongo
+from app import mongo, profiler
 from app.models import User, Question, ExamResult, Subject
-from app.utils import import_from_docx
+from app import exam_sessions, leaderboard, mastery, regrade
+from app.assets import immutable_response
+from app.mathsvg import prerender, question_texts, svg_path
+from app.images import NAME_RE, image_path
+from app.compression import stream_page
+from app.importer import SOURCES, import_file, import_zip
 from bson import ObjectId
+import os
+import re
 
 main_bp = Blueprint('main', __name__)
 
@@ -42,11 +49,13 @@ def exam():
     # Get parameters from request
     limit_arg = request.args.get('limit', '20')
     subject_id = request.args.get('subject_id')
+    practice = request.args.get('mode') == 'practice'
     
     try:
         time_limit = int(request.args.get('time', '20'))
     except ValueError:
         time_limit = 20
+    time_limit = min(max(time_limit, 1), 300)
     
     if limit_arg == 'all':
         if subject_id:
@@ -55,10 +64,13 @@ def exam():
             questions = Question.get_all()
     else:
         try:
-            limit = int(limit_arg)
+            limit = max(1, int(limit_arg))
         except ValueError:
             limit = 20
-        questions = Question.get_random_questions(limit=limit, subject_id=subject_id)
+        if practice:
+            questions = mastery.select_questions(current_user.id, limit, subject_id)
+        else:
+            questions = Question.get_random_questions(limit=limit, subject_id=subject_id)
     
     if len(questions) < 1:
         flash('Không có câu hỏi nào trong ngân hàng cho môn học này.', 'warning')
@@ -70,58 +82,59 @@ def exam():
         if subject:
             subject_name = subject['name']
             
-    return render_template('exam.html', questions=questions, time_limit=time_limit, subject_name=subject_name, subject_id=subject_id)
+    session_id = exam_sessions.create(current_user.id, questions, subject_id, time_limit, practice)
+    render = stream_page if limit_arg == 'all' else render_template
+    return render('exam.html', questions=questions, time_limit=time_limit, subject_name=subject_name,
+                  subject_id=subject_id, practice=practice, session_id=str(session_id),
+                  remaining_seconds=time_limit * 60, answers={})
+
+@main_bp.route('/exam/session/<session_id>')
+@login_required
+def resume_exam(session_id):
+    session = exam_sessions.get(session_id, current_user.id)
+    if not session:
+        flash('Không tìm thấy bài thi', 'error')
+        return redirect(url_for('main.index'))
+    if session.get('summary'):
+        return redirect(url_for('main.result_detail', result_id=session['summary']['result_id']))
+
+    subject_name = "Tổng hợp"
+    if session.get('subject_id'):
+        subject = Subject.get(session['subject_id'])
+        if subject:
+            subject_name = subject['name']
+
+    questions = exam_sessions.questions(session)
+    time_limit = int((session['deadline'] - session['started_at']).total_seconds() // 60)
+    render = stream_page if len(questions) > 100 else render_template
+    return render('exam.html', questions=questions, time_limit=time_limit, subject_name=subject_name,
+                  subject_id=str(session['subject_id']) if session.get('subject_id') else None,
+                  practice=session.get('practice', False), session_id=session_id,
+                  remaining_seconds=exam_sessions.remaining_seconds(session), answers=session['answers'])
+
+@main_bp.route('/api/exam-sessions/<session_id>', methods=['PATCH'])
+@login_required
+def save_exam_answers(session_id):
+    data = request.get_json(silent=True)
+    if (not isinstance(data, dict) or not isinstance(data.get('answers'), dict)
+            or not exam_sessions.valid_delta(data['answers'])):
+        return jsonify({'success': False, 'error': 'Dữ liệu không hợp lệ'}), 400
+    if not exam_sessions.save_answers(session_id, current_user.id, data['answers']):
+        return jsonify({'success': False, 'error': 'Bài thi đã kết thúc hoặc không hợp lệ'}), 409
+    return jsonify({'success': True})
 
 @main_bp.route('/submit_exam', methods=['POST'])
 @login_required
 def submit_exam():
-    data = request.json
-    answers = data.get('answers', {})
-    duration = data.get('duration', 0)
-    subject_id = data.get('subject_id')
-    
-    # Calculate score
-    score = 0
-    detailed_answers = []
-    
-    for qid, user_answer in answers.items():
-        try:
-            question = mongo.db.questions.find_one({'_id': ObjectId(qid)})
-            if question:
-                is_correct = (user_answer == question['correct_answer'])
-                if is_correct:
-                    score += 1
-                
-                detailed_answers.append({
-                    'question_id': str(question['_id']),
-                    'question': question['question'],
-                    'user_answer': user_answer,
-                    'correct_answer': question['correct_answer'],
-                    'is_correct': is_correct,
-                    'options': question['options']
-                })
-        except:
-            continue
-    
-    total_questions = len(detailed_answers)
-    
-    # Save result
-    result_id = ExamResult.create(
-        user_id=current_user.id,
-        score=score,
-        total_questions=total_questions,
-        answers=detailed_answers,
-        duration_seconds=duration,
-        subject_id=subject_id
-    )
-    
-    return jsonify({
-        'success': True,
-        'score': score,
-        'total': total_questions,
-        'percentage': round((score / total_questions) * 100, 2) if total_questions > 0 else 0,
-        'result_id': str(result_id.inserted_id)
-    })
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('answers') or {}, dict):
+        return jsonify({'success': False, 'error': 'Dữ liệu không hợp lệ'}), 400
+    summary = exam_sessions.submit(data.get('session_id'), current_user, data.get('answers'))
+    if summary is None:
+        return jsonify({'success': False, 'error': 'Không tìm thấy bài thi'}), 404
+    if not summary:
+        return jsonify({'success': False, 'error': 'Bài thi đang được chấm, vui lòng thử lại'}), 409
+    return jsonify({'success': True, **summary})
 
 
 
@@ -139,15 +152,38 @@ def results():
                 res['subject_name'] = subject['name']
         else:
             res['subject_name'] = "Thủy văn công trình" # Default fallback
+    
+    rollups = ExamResult.get_rollups(current_user.id, subject_id)
+    for rollup in rollups:
+        subject = Subject.get(rollup['subject_id']) if rollup.get('subject_id') else None
+        rollup['subject_name'] = subject['name'] if subject else "Thủy văn công trình"
             
     subjects = Subject.get_all()
-    return render_template('results.html', results=user_results, subjects=subjects, selected_subject_id=subject_id)
+    return stream_page('results.html', results=user_results, rollups=rollups, subjects=subjects, selected_subject_id=subject_id)
+
+@main_bp.route('/leaderboard')
+@login_required
+def leaderboard_view():
+    subject_id = request.args.get('subject_id')
+    subject_name = None
+    if subject_id:
+        subject = Subject.get(subject_id)
+        if not subject:
+            flash('Không tìm thấy môn học', 'error')
+            return redirect(url_for('main.leaderboard_view'))
+        subject_name = subject['name']
+    
+    board = leaderboard.get_leaderboard(subject_id)
+    subjects = Subject.get_all()
+    return render_template('leaderboard.html', board=board, subjects=subjects,
+                         selected_subject_id=subject_id, subject_name=subject_name)
 
 @main_bp.route('/result/<result_id>')
 @login_required
 def result_detail(result_id):
     try:
-        result = mongo.db.exam_results.find_one({'_id': ObjectId(result_id), 'user_id': ObjectId(current_user.id)})
+        query = {'_id': ObjectId(result_id), 'user_id': ObjectId(current_user.id)}
+        result = mongo.db.exam_results.find_one(query) or mongo.db.exam_results_archive.find_one(query)
         if not result:
             flash('Không tìm thấy kết quả', 'error')
             return redirect(url_for('main.results'))
@@ -156,6 +192,14 @@ def result_detail(result_id):
             subject = Subject.get(result['subject_id'])
             if subject:
                 result['subject_name'] = subject['name']
+
+        # Rendered formulas of the answered questions
+        answers = result.get('answers', [])
+        math = {str(q['_id']): q.get('math') for q in mongo.db.questions.find(
+            {'_id': {'$in': [ObjectId(a['question_id']) for a in answers if ObjectId.is_valid(a.get('question_id'))]}},
+            {'math': 1})}
+        for answer in answers:
+            answer['math'] = math.get(answer.get('question_id'))
         
         return render_template('results_detail.html', result=result)
     except:
@@ -234,19 +278,28 @@ def import_questions():
             flash('Không có file được chọn', 'error')
             return redirect(request.url)
         
-        if file and file.filename.endswith('.docx'):
-            try:
-                count = import_from_docx(file, subject_id)
-                if count > 0:
-                    flash(f'Đã import thành công {count} câu hỏi', 'success')
-                else:
-                    flash('Không tìm thấy câu hỏi nào trong file', 'warning')
-            except Exception as e:
-                flash(f'Lỗi khi import: {str(e)}', 'error')
-        else:
-            flash('Vui lòng chọn file Word (.docx)', 'error')
+        is_zip = file.filename.lower().endswith('.zip')
+        if not is_zip and not any(file.filename.lower().endswith(ext) for ext in SOURCES):
+            flash('Vui lòng chọn file Word (.docx), CSV, Excel (.xlsx), JSON Lines (.jsonl) hoặc file .zip', 'error')
+            return redirect(url_for('main.import_questions'))
+        
+        file_reports = None
+        try:
+            if is_zip:
+                report, file_reports = import_zip(file.stream, subject_id, current_app.config['UPLOAD_FOLDER'],
+                                                  subjects, workers=current_app.config['IMPORT_WORKERS'])
+            else:
+                report = import_file(file.stream, file.filename, subject_id, current_app.config['UPLOAD_FOLDER'])
+        except Exception as e:
+            flash(f'Lỗi khi import: {str(e)}', 'error')
+            return redirect(url_for('main.import_questions'))
         
-        return redirect(url_for('main.import_questions'))
+        if report['inserted'] > 0:
+            flash(f'Đã import thành công {report["inserted"]} câu hỏi', 'success')
+        elif not report['duplicates'] and not report['invalid']:
+            flash('Không tìm thấy câu hỏi nào trong file', 'warning')
+        return render_template('import.html', subjects=subjects, report=report, file_reports=file_reports,
+                             filename=file.filename)
     
     return render_template('import.html', subjects=subjects)
 
@@ -284,14 +337,15 @@ def manage_questions():
         else:
             q['subject_name'] = 'Thủy văn công trình'
     
-    categories = mongo.db.questions.distinct('category')
+    categories = Question.get_categories()
     
-    return render_template('manage_questions.html', questions=questions, categories=categories, subjects=subjects, selected_subject_id=subject_id)
+    return stream_page('manage_questions.html', questions=questions, categories=categories, subjects=subjects, selected_subject_id=subject_id,
+                       regrade_jobs=regrade.active_jobs())
 
 @main_bp.route('/api/questions/categories')
 @login_required
 def get_categories():
-    categories = mongo.db.questions.distinct('category')
+    categories = Question.get_categories()
     return jsonify(categories)
 
 @main_bp.route('/api/questions', methods=['POST'])
@@ -320,13 +374,17 @@ def manage_question_api(question_id=None):
             # Basic validation
             if not new_question['question'] or not new_question['options'] or not new_question['correct_answer']:
                 return jsonify({'success': False, 'error': 'Thiếu thông tin câu hỏi'}), 400
+            
+            new_question['math'] = prerender(question_texts(new_question), current_app.config['UPLOAD_FOLDER'])
                 
             result = mongo.db.questions.insert_one(new_question)
+            Question.invalidate_cache()
             return jsonify({'success': True, 'id': str(result.inserted_id)})
 
         elif request.method == 'DELETE':
             result = mongo.db.questions.delete_one({'_id': ObjectId(question_id)})
             if result.deleted_count > 0:
+                Question.invalidate_cache()
                 return jsonify({'success': True})
             else:
                 return jsonify({'success': False, 'error': 'Question not found'}), 404
@@ -348,6 +406,10 @@ def manage_question_api(question_id=None):
             # Basic validation
             if not update_data['question'] or not update_data['options'] or not update_data['correct_answer']:
                 return jsonify({'success': False, 'error': 'Thiếu thông tin câu hỏi'}), 400
+            
+            update_data['math'] = prerender(question_texts(update_data), current_app.config['UPLOAD_FOLDER'])
+            
+            old_question = mongo.db.questions.find_one({'_id': ObjectId(question_id)}, {'correct_answer': 1})
                 
             result = mongo.db.questions.update_one(
                 {'_id': ObjectId(question_id)},
@@ -355,13 +417,61 @@ def manage_question_api(question_id=None):
             )
             
             if result.modified_count > 0:
-                return jsonify({'success': True})
+                Question.invalidate_cache()
+                response = {'success': True}
+                # Results graded against the old key are regraded in the background
+                if old_question and old_question['correct_answer'] != update_data['correct_answer']:
+                    response['regrade_job'] = regrade.start(question_id)
+                return jsonify(response)
             else:
                 return jsonify({'success': False, 'error': 'Không có thay đổi hoặc không tìm thấy câu hỏi'}), 404
                 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
+@main_bp.route('/api/regrade/<job_id>')
+@login_required
+def regrade_status(job_id):
+    if current_user.role != 'admin':
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+    
+    job = regrade.get_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Không tìm thấy tác vụ'}), 404
+    if regrade.is_stale(job):
+        regrade.resume_stale()
+    
+    return jsonify({
+        'success': True,
+        'status': job['status'],
+        'total': job['total'],
+        'processed': job['processed'],
+        'changed': job['changed'],
+        'error': job.get('error')
+    })
+
+@main_bp.route('/math/<digest>.svg')
+def math_svg(digest):
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        return '', 404
+    path = svg_path(current_app.config['UPLOAD_FOLDER'], digest)
+    if not os.path.isfile(path):
+        return '', 404
+    return immutable_response(path, mimetype='image/svg+xml', etag=digest)
+
+@main_bp.route('/images/<name>')
+def question_image(name):
+    if not NAME_RE.match(name):
+        return '', 404
+    path = image_path(current_app.config['UPLOAD_FOLDER'], name)
+    if not os.path.isfile(path):
+        return '', 404
+    response = immutable_response(path, etag=name)
+    # Uploaded content: never let it run scripts in the app's origin
+    response.headers['Content-Security-Policy'] = 'sandbox'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
 @main_bp.route('/manage-users')
 @login_required
 def manage_users():
@@ -477,6 +587,40 @@ def subject_detail_api(subject_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
+@main_bp.route('/admin/profiling', methods=['GET', 'POST'])
+@login_required
+def profiling():
+    if current_user.role != 'admin':
+        flash('Bạn không có quyền truy cập trang này', 'error')
+        return redirect(url_for('main.index'))
+    
+    if request.method == 'POST':
+        try:
+            profiler.configure(float(request.form.get('rate', '0')) / 100, request.form.get('endpoint'))
+        except ValueError:
+            flash('Tỷ lệ lấy mẫu không hợp lệ', 'error')
+            return redirect(url_for('main.profiling'))
+        flash('Đã cập nhật cấu hình profiling', 'success')
+        return redirect(url_for('main.profiling'))
+    
+    profiled = profiler.endpoints()
+    selected = request.args.get('route')
+    if selected not in profiled:
+        selected = profiled[0] if profiled else None
+    sort = 'total' if request.args.get('sort') == 'total' else 'self'
+    summary = profiler.summarize(selected, sort=sort) if selected else None
+    
+    endpoints = sorted({rule.endpoint for rule in current_app.url_map.iter_rules() if rule.endpoint != 'static'})
+    
+    return render_template('profiling.html',
+                         rate=profiler.rate * 100,
+                         endpoint=profiler.endpoint,
+                         endpoints=endpoints,
+                         profiled=profiled,
+                         selected=selected,
+                         sort=sort,
+                         summary=summary)
+
 @main_bp.route('/profile')
 @login_required
 def profile():
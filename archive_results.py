@@ -0,0 +1,17 @@
+import sys
+
+from app import create_app
+from app.archive import archive_results, rebuild_rollups
+
+app = create_app()
+
+with app.app_context():
+    if len(sys.argv) > 1 and sys.argv[1] == '--rebuild-rollups':
+        print("Rebuilding rollups from the archive...")
+        print(f"Rebuilt {rebuild_rollups()} rollups.")
+        sys.exit(0)
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else app.config['RESULT_RETENTION_DAYS']
+    print(f"Archiving exam results older than {days} days...")
+    count = archive_results(days)
+    print(f"Archived {count} results.")
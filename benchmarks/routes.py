@@ -0,0 +1,403 @@
+"""Route-level load and regression benchmark.
+
+Seeds a throwaway database with users, subjects, questions and exam results,
+then drives ``create_app()`` through the Flask test client and reports p50/p95
+latency, time to first byte, transfer size and MongoDB calls per request for
+every data size. Clients accept ``br, gzip`` like a browser, so the transfer
+size is what goes over the wire. ``POST /import`` uploads a CSV bank of new
+questions as large as the seeded one, so the import pipeline scales with
+``--sizes`` too.
+
+    python -m benchmarks.routes                       # mongomock, default sizes
+    python -m benchmarks.routes --sizes 200,2000,20000
+    python -m benchmarks.routes --mongo-uri mongodb://localhost:27017/bench_db
+    python -m benchmarks.routes --check               # fail on regression
+    python -m benchmarks.routes --update-baseline
+
+DB calls are counted from the ``Server-Timing`` header written by the metrics
+layer. With a real ``mongod`` they come from the PyMongo command listener;
+with mongomock the collections are wrapped so every call is recorded the same
+way. DB call counts are machine independent and compared exactly; latencies
+are compared with a tolerance, so regenerate the baseline on the machine that
+runs ``--check``.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import bcrypt
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+PASSWORD = 'bench-password'
+SERVER_TIMING_DB = re.compile(r'desc="(\d+) queries"')
+
+# Collection methods that issue a command; wrapped when running on mongomock.
+DB_METHODS = {
+    'find', 'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many',
+    'replace_one', 'delete_one', 'delete_many', 'count_documents', 'distinct',
+    'aggregate', 'bulk_write', 'find_one_and_update', 'find_one_and_replace',
+    'find_one_and_delete', 'create_index', 'estimated_document_count',
+}
+
+
+class CountingCollection:
+    """mongomock collection proxy reporting each call to the metrics layer."""
+
+    def __init__(self, collection, metrics):
+        self._collection = collection
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in DB_METHODS:
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._metrics.record_command(name, time.perf_counter() - start)
+        return call
+
+
+class CountingDatabase:
+    def __init__(self, db, metrics):
+        self._db = db
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return CountingCollection(self._db[name], self._metrics)
+
+    def __getitem__(self, name):
+        return CountingCollection(self._db[name], self._metrics)
+
+    def drop_collection(self, name):
+        return self._db.drop_collection(name)
+
+    def list_collection_names(self):
+        return self._db.list_collection_names()
+
+
+def make_app(mongo_uri=None):
+    if mongo_uri:
+        os.environ['MONGO_URI'] = mongo_uri
+    # Indexes are created below, once the database is in place
+    os.environ['MONGO_ENSURE_INDEXES'] = '0'
+    # DB call counts are read from the Server-Timing header
+    os.environ['METRICS_SERVER_TIMING'] = '1'
+
+    from app import create_app, metrics, mongo
+
+    app = create_app()
+    app.config['TESTING'] = True
+
+    if not mongo_uri:
+        import mongomock
+
+        mongo.cx = mongomock.MongoClient()
+        mongo.db = CountingDatabase(mongo.cx['bench_db'], metrics)
+
+    return app, mongo
+
+
+def reset_db(db):
+    for name in db.list_collection_names():
+        if not name.startswith('system.'):
+            db.drop_collection(name)
+
+
+def seed(db, size, users, subjects, rng):
+    """Seed one data size: ``size`` questions and ``size // 5`` results for the student."""
+    reset_db(db)
+
+    password = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(4))
+    now = datetime.utcnow()
+    user_docs = [{
+        'username': 'admin', 'email': 'admin@bench.local', 'password': password,
+        'role': 'admin', 'created_at': now,
+    }]
+    for i in range(users):
+        user_docs.append({
+            'username': f'student{i}', 'email': f'student{i}@bench.local',
+            'password': password, 'role': 'user', 'created_at': now,
+        })
+    user_ids = db.users.insert_many(user_docs).inserted_ids
+
+    subject_ids = db.subjects.insert_many([
+        {'name': f'Môn học {i}', 'description': '', 'created_at': now}
+        for i in range(subjects)
+    ]).inserted_ids
+
+    questions = []
+    for i in range(size):
+        questions.append({
+            'question': f'Câu hỏi {i}: lưu lượng $Q_{{{i}}} = V \\times A$ của lưu vực?',
+            'options': {k: f'Phương án {k} cho câu {i}' for k in 'abcd'},
+            'correct_answer': rng.choice('abcd'),
+            'category': f'Chương {i % 8}',
+            'difficulty': rng.choice(['easy', 'medium', 'hard']),
+            'subject_id': subject_ids[i % subjects],
+            'created_at': now,
+        })
+    db.questions.insert_many(questions)
+
+    results = []
+    for user_id in user_ids[1:]:
+        for i in range(max(1, size // 5)):
+            picked = rng.sample(questions, min(20, len(questions)))
+            answers = []
+            for q in picked:
+                user_answer = rng.choice('abcd')
+                answers.append({
+                    'question_id': str(q['_id']),
+                    'question': q['question'],
+                    'user_answer': user_answer,
+                    'correct_answer': q['correct_answer'],
+                    'is_correct': user_answer == q['correct_answer'],
+                    'options': q['options'],
+                })
+            score = sum(a['is_correct'] for a in answers)
+            results.append({
+                'user_id': user_id,
+                'subject_id': picked[0]['subject_id'],
+                'score': score,
+                'total_questions': len(answers),
+                'percentage': score / len(answers) * 100,
+                'answers': answers,
+                'duration_seconds': rng.randint(60, 1200),
+                'completed_at': now - timedelta(minutes=i),
+            })
+        if len(results) >= 5000:
+            db.exam_results.insert_many(results)
+            results = []
+    if results:
+        db.exam_results.insert_many(results)
+
+    return [q['_id'] for q in questions]
+
+
+def login(app, username):
+    client = app.test_client()
+    client.environ_base['HTTP_ACCEPT_ENCODING'] = 'br, gzip'
+    response = client.post('/login', data={'username': username, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'Login failed for {username}')
+    return client
+
+
+def start_sessions(app, username, question_ids, count, rng):
+    """Open ``count`` exam sessions with 20 answered questions each; return (session id, question ids)."""
+    from app import exam_sessions, mongo
+
+    with app.app_context():
+        user_id = mongo.db.users.find_one({'username': username})['_id']
+        sessions = []
+        for _ in range(count):
+            picked = [{'_id': qid} for qid in rng.sample(question_ids, min(20, len(question_ids)))]
+            session_id = exam_sessions.create(user_id, picked, None, time_limit=20)
+            exam_sessions.save_answers(session_id, user_id, {str(q['_id']): rng.choice('abcd') for q in picked})
+            sessions.append((str(session_id), [str(q['_id']) for q in picked]))
+    return sessions
+
+
+def import_files(size, count):
+    """``count`` CSV banks of ``size`` new questions each (no formulas: no SVG rendering into uploads/)."""
+    files = []
+    for n in range(count):
+        lines = ['question,a,b,c,d,answer,category,difficulty']
+        for i in range(size):
+            lines.append(f'Câu hỏi nhập {n}-{i} về dòng chảy lũ?,Phương án a,Phương án b,'
+                         f'Phương án c,Phương án d,{"abcd"[i % 4]},Chương {i % 8},medium')
+        files.append('\n'.join(lines).encode('utf-8'))
+    return files
+
+
+def build_scenarios(app, question_ids, rng, repeat):
+    student = login(app, 'student0')
+    admin = login(app, 'admin')
+    # One bank the size of the seeded one per upload (plus the warm-up)
+    uploads = import_files(len(question_ids), repeat + 1)
+    with app.app_context():
+        from app import mongo
+        subject_id = str(mongo.db.subjects.find_one()['_id'])
+    # One session per submission (plus the warm-up), another one for autosaves
+    submit_sessions = start_sessions(app, 'student0', question_ids, repeat + 1, rng)
+    (autosave_session, autosave_questions), = start_sessions(app, 'student0', question_ids, 1, rng)
+
+    def submit():
+        return student.post('/submit_exam', json={'session_id': submit_sessions.pop()[0], 'answers': {}})
+
+    def autosave():
+        answers = {rng.choice(autosave_questions): rng.choice('abcd')}
+        return student.patch(f'/api/exam-sessions/{autosave_session}', json={'answers': answers})
+
+    def import_bank():
+        return admin.post('/import', content_type='multipart/form-data', data={
+            'subject_id': subject_id,
+            'file': (io.BytesIO(uploads.pop()), 'bank.csv'),
+        })
+
+    return [
+        ('GET /', lambda: student.get('/')),
+        ('GET /exam', lambda: student.get('/exam?limit=20')),
+        ('GET /exam practice', lambda: student.get('/exam?limit=20&mode=practice')),
+        ('GET /exam all', lambda: student.get('/exam?limit=all')),
+        ('PATCH /api/exam-sessions', autosave),
+        ('POST /submit_exam', submit),
+        ('GET /results', lambda: student.get('/results')),
+        ('GET /statistics', lambda: student.get('/statistics')),
+        ('GET /leaderboard', lambda: student.get('/leaderboard')),
+        ('GET /manage-questions', lambda: admin.get('/manage-questions')),
+        ('GET /import', lambda: admin.get('/import')),
+        # Last: every upload adds a bank's worth of questions
+        ('POST /import', import_bank),
+    ]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_scenario(request, repeat):
+    request()  # warm-up: template compilation, first-use imports
+    timings = []
+    ttfb = []
+    sizes = []
+    db_calls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = request()
+        # Streamed bodies are rendered while they are iterated
+        chunks = iter(response.response)
+        first = next(chunks, b'')
+        ttfb.append((time.perf_counter() - start) * 1000)
+        sizes.append(len(first) + sum(len(chunk) for chunk in chunks))
+        timings.append((time.perf_counter() - start) * 1000)
+        response.close()
+
+        if response.status_code >= 300:
+            raise RuntimeError(f'HTTP {response.status_code} from {response.request.path}')
+        match = SERVER_TIMING_DB.search(response.headers.get('Server-Timing', ''))
+        db_calls.append(int(match.group(1)) if match else 0)
+
+    return {
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'ttfb_ms': round(percentile(ttfb, 50), 2),
+        'kb': round(statistics.median(sizes) / 1024, 1),
+        'db_calls': int(statistics.median(db_calls)),
+    }
+
+
+def run(args):
+    if args.mongo_uri and not re.search(r'bench|test', args.mongo_uri.rsplit('/', 1)[-1]):
+        raise SystemExit('Refusing to drop a database whose name does not contain "bench" or "test".')
+
+    app, mongo = make_app(args.mongo_uri)
+    from app.cache import cache
+    from app.models import ensure_indexes
+
+    rng = random.Random(args.seed)
+    report = {}
+
+    # Requests must not run inside a long-lived app context: ``g`` (and the
+    # user Flask-Login caches on it) would leak from one request to the next.
+    for size in args.sizes:
+        with app.app_context():
+            question_ids = seed(mongo.db, size, args.users, args.subjects, rng)
+            ensure_indexes()
+            cache.clear()  # seeding bypasses the model layer and its invalidation
+        report[str(size)] = {}
+        for name, request in build_scenarios(app, question_ids, rng, args.repeat):
+            report[str(size)][name] = run_scenario(request, args.repeat)
+
+    if args.mongo_uri:
+        with app.app_context():
+            reset_db(mongo.db)
+
+    return report
+
+
+def print_report(report):
+    print(f'{"size":>7}  {"route":<24}{"p50 ms":>10}{"p95 ms":>10}{"ttfb ms":>10}{"KB":>10}{"db calls":>10}')
+    for size, routes in report.items():
+        for name, row in routes.items():
+            print(f'{size:>7}  {name:<24}{row["p50_ms"]:>10.2f}{row["p95_ms"]:>10.2f}'
+                  f'{row["ttfb_ms"]:>10.2f}{row["kb"]:>10.1f}{row["db_calls"]:>10}')
+
+
+def compare(report, baseline, tolerance, min_delta_ms):
+    """Return the list of regressions of ``report`` against ``baseline``."""
+    failures = []
+    for size, routes in report.items():
+        for name, row in routes.items():
+            base = baseline.get(size, {}).get(name)
+            if not base:
+                continue
+            if row['db_calls'] > base['db_calls']:
+                failures.append(f'{name} @ {size}: {row["db_calls"]} DB calls (baseline {base["db_calls"]})')
+            # p50 rather than p95: the tail is too noisy across runs to gate on.
+            limit = max(base['p50_ms'] * (1 + tolerance), base['p50_ms'] + min_delta_ms)
+            if row['p50_ms'] > limit:
+                failures.append(f'{name} @ {size}: p50 {row["p50_ms"]:.2f} ms (baseline {base["p50_ms"]:.2f} ms)')
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='200,2000',
+                        type=lambda s: [int(x) for x in s.split(',') if x],
+                        help='comma separated question counts to seed (default: 200,2000)')
+    parser.add_argument('--users', type=int, default=3, help='students to seed')
+    parser.add_argument('--subjects', type=int, default=5, help='subjects to seed')
+    parser.add_argument('--repeat', type=int, default=20, help='timed requests per route')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data set')
+    parser.add_argument('--mongo-uri', help='use a throwaway mongod instead of mongomock (the database is dropped)')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline file')
+    parser.add_argument('--check', action='store_true', help='exit non-zero on regression against the baseline')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help='allowed relative p50 slowdown before failing (default: 1.0, i.e. 2x)')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0,
+                        help='ignore p50 slowdowns smaller than this (default: 5)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    print_report(report)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+
+    if args.check:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        failures = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        if failures:
+            print('\nRegressions:')
+            for failure in failures:
+                print(f'  {failure}')
+            return 1
+        print('\nNo regressions against baseline.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+import os
+import sys
+
+from app.assets import build
+
+static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'static')
+download = '--no-download' not in sys.argv
+
+print("Building static assets...")
+manifest = build(static_folder, download=download)
+print(f"Fingerprinted {len(manifest)} files into {os.path.join(static_folder, 'dist')}")
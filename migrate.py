@@ -0,0 +1,25 @@
+import argparse
+
+from app import create_app
+from app.migrations import BATCH_SIZE, PAUSE, MigrationLocked, migrate, status
+
+parser = argparse.ArgumentParser(description='Apply pending data migrations.')
+parser.add_argument('--status', action='store_true', help='list migrations and exit')
+parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='documents per chunk')
+parser.add_argument('--pause', type=float, default=PAUSE, help='seconds to wait between chunks')
+args = parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+    if args.status:
+        for migration_id, description, record in status():
+            state = record['status'] if record else 'pending'
+            print(f"{migration_id:<24} {state:<8} {description}")
+        raise SystemExit(0)
+
+    try:
+        applied = migrate(args.batch_size, args.pause, log=print)
+    except MigrationLocked as e:
+        raise SystemExit(f"Migration skipped: {e}")
+    print(f"Applied {len(applied)} migrations." if applied else "Nothing to migrate.")
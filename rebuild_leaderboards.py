@@ -0,0 +1,17 @@
+import sys
+
+from app import create_app
+from app import leaderboard
+
+app = create_app()
+
+with app.app_context():
+    subject_id = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if subject_id:
+        print(f"Rebuilding leaderboard for subject {subject_id}...")
+    else:
+        print("Rebuilding all leaderboards...")
+
+    count = leaderboard.rebuild(subject_id)
+    print(f"Rebuilt {count} leaderboards.")
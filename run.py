@@ -1,8 +1,15 @@
-from app import create_app
+from app import create_app, regrade
 import os
 
-app = create_app()
-
 if __name__ == '__main__':
+    # Built here, not at import time: zip imports run "spawn" worker
+    # processes, which re-import this module.
+    app = create_app()
+    with app.app_context():
+        try:
+            # Regrades cut short by the last shutdown
+            regrade.resume_stale()
+        except Exception as e:
+            app.logger.warning('Could not resume regrade jobs: %s', e)
     debug_mode = os.environ.get('FLASK_DEBUG', '0') == '1'
     app.run(host='0.0.0.0', port=5000, debug=debug_mode)
@@ -0,0 +1,133 @@
+import os
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import mongomock
+from bson import ObjectId
+
+os.environ.setdefault('MONGO_ENSURE_INDEXES', '0')
+
+from app import create_app, mongo, regrade  # noqa: E402
+from app.mastery import _doc_id  # noqa: E402
+
+
+class Crash(BaseException):
+    """Stands for the process dying: not caught by the job's error handling."""
+
+
+class RestartedRegradeTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        mongo.cx = mongomock.MongoClient()
+        mongo.db = mongo.cx['test']
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        self.subject_id = mongo.db.subjects.insert_one({'name': 'Thủy văn'}).inserted_id
+        self.question_id = mongo.db.questions.insert_one({
+            'question': 'Q', 'options': {'a': '1', 'b': '2'}, 'correct_answer': 'a', 'subject_id': self.subject_id,
+        }).inserted_id
+        qid = str(self.question_id)
+        self.users = [mongo.db.users.insert_one({'username': f'u{i}', 'role': 'user'}).inserted_id for i in range(3)]
+
+        for n, user_id in enumerate(self.users):
+            picks = ['a', 'b', 'b', 'a', 'b'][:n + 3]
+            for i, pick in enumerate(picks):
+                collection = mongo.db.exam_results_archive if i == 0 else mongo.db.exam_results
+                collection.insert_one({
+                    'user_id': user_id, 'subject_id': self.subject_id, 'total_questions': 2,
+                    'score': 1 + (pick == 'a'), 'percentage': 50.0 * (1 + (pick == 'a')),
+                    'completed_at': datetime(2025, 1, 10 + i),
+                    'answers': [
+                        {'question_id': qid, 'user_answer': pick, 'correct_answer': 'a', 'is_correct': pick == 'a'},
+                        {'question_id': str(ObjectId()), 'user_answer': 'c', 'correct_answer': 'c', 'is_correct': True},
+                    ],
+                })
+            mongo.db.mastery.insert_one({
+                '_id': _doc_id(user_id, self.subject_id), 'user_id': user_id, 'subject_id': self.subject_id,
+                'items': {qid: {'a': len(picks), 'c': picks.count('a'), 's': 0, 't': 0}},
+            })
+
+        mongo.db.questions.update_one({'_id': self.question_id}, {'$set': {'correct_answer': 'b'}})
+        self.job_id = ObjectId(self.start())
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def start(self):
+        with mock.patch.object(regrade, '_spawn'):
+            return regrade.start(self.question_id)
+
+    def crash_run(self, where):
+        """Run the job until it dies at ``where``."""
+        bulk_write = mongomock.collection.Collection.bulk_write
+        calls = []
+
+        def failing_bulk_write(collection, requests, **kwargs):
+            if collection.name == 'exam_results':
+                calls.append(1)
+                if len(calls) == 2 and where == 'before_write':
+                    raise Crash()
+                result = bulk_write(collection, requests, **kwargs)
+                if len(calls) == 2 and where == 'after_write':
+                    raise Crash()
+                return result
+            return bulk_write(collection, requests, **kwargs)
+
+        patches = [mock.patch.object(regrade, 'BATCH_SIZE', 2),
+                   mock.patch.object(mongomock.collection.Collection, 'bulk_write', failing_bulk_write)]
+        if where == 'derived':
+            patches.append(mock.patch.object(regrade.leaderboard, 'refresh_users', side_effect=Crash()))
+        for patch in patches:
+            patch.start()
+        try:
+            with self.assertRaises(Crash):
+                regrade._run(self.app, self.job_id)
+        finally:
+            for patch in patches:
+                patch.stop()
+
+    def resume(self):
+        mongo.db.regrade_jobs.update_one({'_id': self.job_id},
+                                         {'$set': {'updated_at': datetime.utcnow() - regrade.JOB_LEASE * 2}})
+        with mock.patch.object(regrade, 'BATCH_SIZE', 2), \
+                mock.patch.object(regrade, '_spawn', lambda job_id: regrade._run(self.app, job_id)):
+            return regrade.resume_stale()
+
+    def assert_consistent(self):
+        qid = str(self.question_id)
+        self.assertEqual(regrade.get_job(self.job_id)['status'], 'done')
+        for user_id in self.users:
+            correct = 0
+            for collection in (mongo.db.exam_results, mongo.db.exam_results_archive):
+                for result in collection.find({'user_id': user_id}):
+                    answer = result['answers'][0]
+                    self.assertEqual(answer['correct_answer'], 'b')
+                    self.assertEqual(answer['is_correct'], answer['user_answer'] == 'b')
+                    self.assertEqual(result['score'], sum(a['is_correct'] for a in result['answers']))
+                    correct += answer['is_correct']
+            items = mongo.db.mastery.find_one({'_id': _doc_id(user_id, self.subject_id)})['items']
+            self.assertEqual(items[qid]['c'], correct)
+
+    def test_fresh_job_is_not_resumed(self):
+        self.assertEqual(regrade.resume_stale(), [])
+
+    def restart(self, where):
+        self.crash_run(where)
+        self.assertEqual(regrade.get_job(self.job_id)['status'], 'running')
+        self.assertEqual(self.resume(), [str(self.job_id)])
+        self.assert_consistent()
+
+    def test_restart_before_batch_write(self):
+        self.restart('before_write')
+
+    def test_restart_after_batch_write(self):
+        self.restart('after_write')
+
+    def test_restart_after_mastery_adjusted(self):
+        self.restart('derived')
+
+
+if __name__ == '__main__':
+    unittest.main()